@@ -1,33 +1,92 @@
+import os
 import json
 import numpy
 import bisect
+import logging
 import operator
+import threading
 import ifcopenshell
 
-def create(ifc, obj, ofn):
+log = logging.getLogger(__name__)
 
+# The storey table of an upload is stored in its job directory under this name
+STOREYS_FILE = "storeys.json"
+
+def read_storeys(ifc):
+    """
+    Returns the elevations and GlobalIds of the building storeys in an
+    IFC file, sorted by elevation.
+    """
     f = ifcopenshell.open(ifc)
     ss = sorted(f.by_type("IfcBuildingStorey"), key=operator.attrgetter("Elevation"))
-    elevations = list(map(operator.attrgetter("Elevation"), ss))
+    return list(map(operator.attrgetter("Elevation"), ss)), list(map(operator.attrgetter("GlobalId"), ss))
+
+def index_storeys(ifc, cwd):
+    """
+    Extracts the storey table of an IFC file into job directory cwd.
+    """
+    elevations, ids = read_storeys(ifc)
+    with open(os.path.join(cwd, STOREYS_FILE), "w") as f:
+        json.dump({"elevations": elevations, "ids": ids}, f)
+    return elevations, ids
+
+# job directory -> thread extracting its storey table, see start_indexing()
+indexing = {}
+indexing_lock = threading.Lock()
+
+def start_indexing(cwd):
+    """
+    Extracts the storey table of job directory cwd in a background thread,
+    so that input.ifc is parsed while voxec runs rather than afterwards.
+    """
+    def run():
+        try:
+            index_storeys(os.path.join(cwd, "input.ifc"), cwd)
+        except Exception:
+            log.exception("could not index storeys of %s", cwd)
+        finally:
+            with indexing_lock:
+                indexing.pop(cwd, None)
+    t = threading.Thread(target=run, daemon=True)
+    with indexing_lock:
+        indexing[cwd] = t
+    t.start()
+
+def load_storeys(cwd):
+    """
+    Returns the storey table of job directory cwd, waiting for
+    start_indexing() if it is still running. Extracted from input.ifc
+    if it was not indexed before.
+    """
+    with indexing_lock:
+        t = indexing.get(cwd)
+    if t is not None:
+        t.join()
+    try:
+        with open(os.path.join(cwd, STOREYS_FILE)) as f:
+            d = json.load(f)
+        return d["elevations"], d["ids"]
+    except (EnvironmentError, ValueError, KeyError):
+        return index_storeys(os.path.join(cwd, "input.ifc"), cwd)
+
+# groups: names and lowest z coordinates as collected by prepared_buffer
+def create(storeys, groups, ofn):
+
+    elevations, ids = storeys
 
     objects = []
 
-    for l in open(obj):
-        args = l.strip().split(" ")
-        a = args[0]
-        bs = args[1:]
-        if a == "v":
-            objects[-1]["storey"] = min(objects[-1]["storey"], float(bs[2]))
-        elif a == "g":
-            objects.append({"name": bs[0], "storey": float("inf")})
-
-    for o in objects:
-        idx = bisect.bisect_left(elevations, o["storey"])
+    for name, z in groups:
+        idx = bisect.bisect_left(elevations, z)
         idx = max(idx - 1, 0)
-        o["storey"] = ss[idx].GlobalId
+        objects.append({"name": name, "storey": ids[idx]})
 
     json.dump(objects, open(ofn, "w"))
 
 if __name__ == "__main__":
     import sys
-    create(*sys.argv[1:])
+    import prepared_buffer
+    ifc, obj, ofn = sys.argv[1:]
+    groups = []
+    prepared_buffer.read_obj(obj, groups=groups)
+    create(read_storeys(ifc), groups, ofn)
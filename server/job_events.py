@@ -0,0 +1,274 @@
+import os
+import json
+import bisect
+import time
+import logging
+import threading
+
+import jobs
+
+log = logging.getLogger(__name__)
+
+
+class file_tail(object):
+    """
+    Reads a file that is being appended to incrementally, from the offset
+    up to which it was read before. Lines are only returned once they
+    are complete, the file does not need to exist yet. When the file is
+    replaced or truncated it is read from the start again, and restarted
+    is set.
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.f = None
+        self.rest = b""
+        # byte offset up to which complete lines have been returned
+        self.offset = 0
+        self.restarted = False
+
+    def read(self):
+        return [l for _, l in self.read_with_offsets()]
+
+    def read_with_offsets(self):
+        """
+        The new complete lines as (byte offset in the file, line).
+        """
+        if self.f is not None:
+            try:
+                st = os.stat(self.fn)
+            except EnvironmentError:
+                st = None
+            if st is None or st.st_ino != os.fstat(self.f.fileno()).st_ino or st.st_size < self.f.tell():
+                self.close()
+                self.f, self.rest, self.offset, self.restarted = None, b"", 0, True
+        if self.f is None:
+            try:
+                self.f = open(self.fn, "rb")
+            except EnvironmentError:
+                return []
+        data = self.rest + self.f.read()
+        end = data.rfind(b"\n") + 1
+        self.rest = data[end:]
+        lines = []
+        for l in data[:end].split(b"\n")[:-1]:
+            lines.append((self.offset, l.decode("utf-8", "replace")))
+            self.offset += len(l) + 1
+        return lines
+
+    def partial(self):
+        return self.rest.decode("utf-8", "replace")
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+
+
+class line_index(object):
+    """
+    The lines of a file that is being appended to read so far, addressed
+    by the byte offset of their line in the file. New lines are read by
+    update(), read() returns the lines from an offset on.
+    """
+
+    def __init__(self, fn):
+        self.tail = file_tail(fn)
+        self.entries = []
+        self.offsets = []
+        # the line currently being written
+        self.partial = ""
+        self.lock = threading.Lock()
+
+    def parse(self, l):
+        return l
+
+    def update(self):
+        with self.lock:
+            lines = self.tail.read_with_offsets()
+            if self.tail.restarted:
+                self.tail.restarted = False
+                self.entries, self.offsets = [], []
+            for offset, l in lines:
+                try:
+                    self.entries.append(self.parse(l))
+                    self.offsets.append(offset)
+                except ValueError as e:
+                    log.warning("invalid line in %s: %s", self.tail.fn, e)
+            self.partial = self.tail.partial()
+
+    def read(self, since=0, update=True):
+        """
+        Returns the entries from byte offset since, which is the offset of
+        an entry or the end of the entries read so far, and the offset of
+        the next entry. Raises ValueError for other offsets.
+        """
+        if update:
+            self.update()
+        with self.lock:
+            i = bisect.bisect_left(self.offsets, since)
+            if since not in (0, self.tail.offset) and (i == len(self.offsets) or self.offsets[i] != since):
+                raise ValueError("not the offset of a line: %d" % since)
+            return self.entries[i:], self.tail.offset
+
+    def close(self):
+        self.tail.close()
+
+    def __del__(self):
+        self.tail.close()
+
+
+class log_index(line_index):
+    """
+    The entries of a log.json parsed so far, new lines are parsed when
+    entries are requested, so that no line is parsed twice.
+    """
+
+    def parse(self, l):
+        return json.loads(l)
+
+
+class job_feed(object):
+    """
+    The output and state of the job in directory cwd, shared by all of its
+    event streams, see subscribe(). The files and status() are read at
+    most once per interval, however many clients follow the job.
+    """
+
+    def __init__(self, cwd, status, interval):
+        self.progress = line_index(os.path.join(cwd, "progress"))
+        self.log = log_index(os.path.join(cwd, "log.json"))
+        self.status, self.interval = status, interval
+        self.state, self.polled = None, 0.
+        self.subscribers = 0
+        self.lock = threading.Lock()
+
+    def read(self, since):
+        """
+        Returns the state, the progress lines from byte offset since[0] and
+        the line being written, the log entries from since[1], and the
+        offsets up to which both were read.
+        """
+        with self.lock:
+            if time.time() - self.polled >= self.interval:
+                self.state = self.status()
+                # read after the state, so that the output of a completed
+                # job is drained before the stream ends
+                self.progress.update()
+                self.log.update()
+                self.polled = time.time()
+            read = []
+            for index, offset in zip((self.progress, self.log), since):
+                try:
+                    read.append(index.read(offset, update=False))
+                except ValueError:
+                    # the file was replaced, or the offset is not one sent
+                    read.append(index.read(0, update=False))
+            (lines, progress_next), (entries, log_next) = read
+            return self.state, lines, self.progress.partial, entries, (progress_next, log_next)
+
+    def close(self):
+        self.progress.close()
+        self.log.close()
+
+
+# job directory -> job_feed, while it has streams
+feeds = {}
+feeds_lock = threading.Lock()
+
+
+def subscribe(cwd, status, interval):
+    with feeds_lock:
+        feed = feeds.get(cwd)
+        if feed is None:
+            feed = feeds[cwd] = job_feed(cwd, status, interval)
+        feed.subscribers += 1
+    return feed
+
+
+def unsubscribe(cwd, feed):
+    with feeds_lock:
+        feed.subscribers -= 1
+        if feed.subscribers == 0:
+            del feeds[cwd]
+            feed.close()
+
+
+def event(name, data, id=None):
+    id = "" if id is None else "id: %s\n" % id
+    return "%sevent: %s\ndata: %s\n\n" % (id, name, json.dumps(data))
+
+
+def parse_event_id(id):
+    """
+    The byte offsets in progress and log.json of an event id as sent by
+    stream(), the Last-Event-ID of a reconnecting client, (0, 0) if absent
+    or invalid.
+    """
+    try:
+        since = tuple(int(n) for n in (id or "").split(","))
+    except ValueError:
+        return 0, 0
+    if len(since) != 2 or min(since) < 0:
+        return 0, 0
+    return since
+
+
+def stream(cwd, status, since=(0, 0), interval=1., keepalive=15., unknown=5., idle=600., lifetime=3600.):
+    """
+    Yields server-sent events for the job in directory cwd until it
+    completes: "progress" with the new lines of voxec stdout and the
+    line currently being written, "log" with new log entries, "state"
+    whenever status() changes and a final "end". status() returns the
+    job state as in /progress. Events carry the byte offsets up to which
+    both files were sent as their id, a reconnecting client continues
+    from the offsets since, see parse_event_id().
+    
+    "end" is only sent once the job is done or failed. So that a stream
+    does not hold on to a server thread indefinitely, it also ends when
+    the job has no state for unknown seconds, nothing changed for idle
+    seconds or after lifetime seconds, but without "end", upon which the
+    client reconnects.
+    """
+    feed = subscribe(cwd, status, interval)
+    last_state, last_partial, last_sent = (), "", time.time()
+    started = last_change = time.time()
+
+    try:
+        while True:
+            state, lines, partial, entries, since = feed.read(since)
+
+            messages = []
+            id = "%d,%d" % since
+            if lines or partial != last_partial:
+                messages.append(event("progress", {"lines": lines, "partial": partial}, id))
+                last_partial = partial
+            if entries:
+                messages.append(event("log", entries, id))
+            # wait and elapsed times change continuously, only transitions are sent
+            key = tuple((state or {}).get(k) for k in ("state", "queue_position", "step"))
+            if key != last_state:
+                messages.append(event("state", state, id))
+                last_state = key
+
+            if not messages and time.time() - last_sent > keepalive:
+                # a comment, which keeps proxies from closing the connection
+                messages.append(": keepalive\n\n")
+
+            now = time.time()
+            if messages:
+                if not messages[0].startswith(":"):
+                    last_change = now
+                last_sent = now
+                yield "".join(messages)
+
+            if (state or {}).get("state") in (jobs.DONE, jobs.FAILED):
+                yield event("end", state)
+                return
+            if not (state or {}).get("state") and now - started > unknown:
+                return
+            if now - last_change > idle or now - started > lifetime:
+                return
+
+            time.sleep(interval)
+    finally:
+        unsubscribe(cwd, feed)
@@ -0,0 +1,117 @@
+import os
+import json
+import time
+import datetime
+import subprocess
+
+import jobs
+import progress
+
+# The resource usage of a job is persisted in its directory under this name
+PROFILE_FILE = "profile.json"
+
+
+def run(popen_args, **kwargs):
+    """
+    Runs a process like subprocess.call(), but waits for it with wait4()
+    so that its resource usage is known. Returns the return code and a
+    dict with wall time, cpu time and peak resident set size.
+    """
+    started = time.time()
+    p = subprocess.Popen(popen_args, **kwargs)
+    try:
+        _, status, usage = os.wait4(p.pid, 0)
+    except:
+        p.kill()
+        p.wait()
+        raise
+    finished = time.time()
+    # reaped by wait4(), make sure Popen does not wait for it again
+    p.returncode = rc = os.waitstatus_to_exitcode(status)
+
+    return rc, {
+        "started": started,
+        "finished": finished,
+        "wall_time": finished - started,
+        "user_time": usage.ru_utime,
+        "system_time": usage.ru_stime,
+        "cpu_time": usage.ru_utime + usage.ru_stime,
+        # kilobytes on Linux
+        "max_rss": usage.ru_maxrss * 1024,
+        "returncode": rc
+    }
+
+
+def timestamp(entry):
+    t = entry.get("time", entry.get("timestamp"))
+    if isinstance(t, (int, float)):
+        return float(t)
+    try:
+        return datetime.datetime.fromisoformat(t).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def read_log(cwd):
+    entries = []
+    try:
+        with open(os.path.join(cwd, "log.json")) as f:
+            for l in f:
+                try:
+                    entries.append(json.loads(l))
+                except ValueError:
+                    pass
+    except EnvironmentError:
+        pass
+    return entries
+
+
+def create(cwd, usage, args=None):
+    """
+    Combines the resource usage of voxec for the job in directory cwd
+    with the timings of its statements and post-processing stages, see
+    progress.report(). Log entries that carry a timestamp are counted
+    towards the statement that was running at the time.
+    """
+    steps = progress.report(cwd, {"started": usage["started"]})["steps"]
+    statements = [s for s in steps if s.get("number") is not None]
+
+    entries = read_log(cwd)
+    for s in statements:
+        s["log"] = {}
+    for e in entries:
+        t = timestamp(e)
+        if t is None:
+            continue
+        # entries after the last output belong to the statement that failed
+        s = next((s for s in statements if (s["finished"] and t <= s["finished"]) or s["state"] != "done"), None)
+        if s is not None:
+            severity = e.get("severity", "notice")
+            s["log"][severity] = s["log"].get(severity, 0) + 1
+
+    operations = {}
+    for s in statements:
+        if s["elapsed"] is not None:
+            operations[s["operation"]] = operations.get(s["operation"], 0.) + s["elapsed"]
+
+    return dict(usage,
+        args=dict(args or {}),
+        statements=statements,
+        operations=operations,
+        # post-processing runs in the server process, only its wall time
+        # is attributed to the job
+        stages=[s for s in steps if s.get("number") is None],
+        log_entries=len(entries)
+    )
+
+
+def write(cwd, profile):
+    jobs.write_state(cwd, profile, PROFILE_FILE)
+
+
+def read(cwd):
+    try:
+        with open(os.path.join(cwd, PROFILE_FILE)) as f:
+            return json.load(f)
+    except (EnvironmentError, ValueError):
+        return None
@@ -0,0 +1,231 @@
+import os
+import json
+import time
+import logging
+import binascii
+import itertools
+import threading
+
+from queue import PriorityQueue
+from multiprocessing import cpu_count
+
+log = logging.getLogger(__name__)
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+# Job state is persisted in the job directory under this name
+STATE_FILE = "job.json"
+
+# Identifies this process in persisted job state. Process ids repeat, in
+# containers the server usually runs with the same pid after a restart.
+PROCESS_TOKEN = "%d-%s" % (os.getpid(), binascii.hexlify(os.urandom(8)).decode("ascii"))
+
+
+def cpu_budget():
+    """
+    Number of cores that concurrently running voxec processes may use
+    together, VOXEC_CPU_BUDGET or all cores by default.
+    """
+    return max(1, int(os.environ.get("VOXEC_CPU_BUDGET") or cpu_count()))
+
+
+def process_alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def process_owns(state):
+    """
+    Whether the process that queued or ran a job still exists. A job of
+    an earlier process with the same pid as this one is not owned.
+    """
+    pid = state.get("pid")
+    if pid == os.getpid():
+        return state.get("process") == PROCESS_TOKEN
+    return process_alive(pid)
+
+
+def read_state(cwd):
+    """
+    Reads the persisted state of a job, None if the job is unknown. A job
+    that is queued or running in a process that no longer exists, because
+    the server was restarted, is reported as failed.
+    """
+    try:
+        with open(os.path.join(cwd, STATE_FILE)) as f:
+            state = json.load(f)
+    except (EnvironmentError, ValueError):
+        return None
+    if state.get("state") in (QUEUED, RUNNING) and not process_owns(state):
+        state["state"] = FAILED
+    return state
+
+
+def write_state(cwd, state, name=STATE_FILE):
+    # write and rename, so that readers never observe a partial file
+    fn = os.path.join(cwd, name)
+    try:
+        with open(fn + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(fn + ".tmp", fn)
+    except EnvironmentError as e:
+        log.warning("could not write %s: %s", fn, e)
+
+
+class core_allocator(object):
+    """
+    Hands out the number of threads for a voxec process from a fixed
+    budget of cores, dividing the budget evenly among the jobs that are
+    running or queued when the process starts.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.in_use = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, active, requested=None):
+        with self.lock:
+            share = max(1, self.budget // max(1, active))
+            grant = min(share, max(1, self.budget - self.in_use))
+            if requested:
+                grant = min(grant, int(requested))
+            self.in_use += grant
+            return grant
+
+    def release(self, n):
+        with self.lock:
+            self.in_use -= n
+
+
+class job(object):
+
+    def __init__(self, cwd, id, fn, args, priority, seq):
+        self.cwd, self.id, self.fn, self.args, self.priority, self.seq = cwd, id, fn, args, priority, seq
+        self.state = QUEUED
+        self.queued = time.time()
+        self.started = self.finished = None
+        self.completed = threading.Event()
+
+    def wait(self):
+        self.completed.wait()
+        return self.state
+
+    def set_state(self, state):
+        self.state = state
+        if state == RUNNING:
+            self.started = time.time()
+        elif state in (DONE, FAILED):
+            self.finished = time.time()
+        self.persist()
+
+    def wait_time(self):
+        return (self.started or time.time()) - self.queued
+
+    def to_dict(self):
+        return {
+            "state": self.state,
+            "priority": self.priority,
+            "queued": self.queued,
+            "started": self.started,
+            "finished": self.finished,
+            "wait_time": self.wait_time()
+        }
+
+    def persist(self):
+        # the process that handles the job, see read_state()
+        write_state(self.cwd, dict(self.to_dict(), pid=os.getpid(), process=PROCESS_TOKEN))
+
+
+class job_queue(object):
+    """
+    A priority queue of voxec jobs processed by a bounded pool of worker
+    threads. Lower priority values are processed first, jobs of equal
+    priority in order of submission. Synchronous jobs bypass the queue,
+    see run(). The pool is per process, so with multiple gunicorn workers
+    the bound applies to each of them.
+    """
+
+    def __init__(self, num_workers):
+        self.num_workers = num_workers
+        self.queue = PriorityQueue()
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        # queued and running jobs by id
+        self.jobs = {}
+        # number of jobs completed by this process per final state
+        self.totals = {DONE: 0, FAILED: 0}
+        self.workers = []
+
+    def submit(self, cwd, id, fn, args=(), priority=1):
+        j = job(cwd, id, fn, args, priority, next(self.counter))
+        j.persist()
+        with self.lock:
+            self.jobs[id] = j
+            # workers are started on first use, not at import time
+            while len(self.workers) < self.num_workers:
+                t = threading.Thread(target=self.work, daemon=True)
+                t.start()
+                self.workers.append(t)
+        self.queue.put((priority, j.seq, j))
+        return j
+
+    def run(self, cwd, id, fn, args=()):
+        """
+        Runs a job in the calling thread, for a client that waits for its
+        result, so that it does not queue behind long asynchronous jobs.
+        It is counted as running, see counts(). Returns the final state.
+        """
+        j = job(cwd, id, fn, args, 0, next(self.counter))
+        with self.lock:
+            self.jobs[id] = j
+        self.execute(j)
+        return j.state
+
+    def work(self):
+        while True:
+            _, _, j = self.queue.get()
+            self.execute(j)
+
+    def execute(self, j):
+        j.set_state(RUNNING)
+        try:
+            state = DONE if j.fn(*j.args) is not False else FAILED
+        except Exception:
+            log.exception("job %s failed", j.id)
+            state = FAILED
+        j.set_state(state)
+        with self.lock:
+            del self.jobs[j.id]
+            self.totals[state] += 1
+        j.completed.set()
+
+    def counts(self):
+        with self.lock:
+            states = [j.state for j in self.jobs.values()]
+        return {s: states.count(s) for s in (QUEUED, RUNNING)}
+
+    def status(self, id):
+        """
+        State of a queued or running job, with its position in the queue,
+        None if the job is not handled by this process.
+        """
+        with self.lock:
+            j = self.jobs.get(id)
+            if j is None:
+                return None
+            queued = sorted((q for q in self.jobs.values() if q.state == QUEUED), key=lambda q: (q.priority, q.seq))
+            running = sum(1 for q in self.jobs.values() if q.state == RUNNING)
+            position = queued.index(j) if j in queued else None
+        d = j.to_dict()
+        d["queue_position"] = position
+        d["queue_depth"] = len(queued)
+        d["running"] = running
+        return d
@@ -1,29 +1,40 @@
 from __future__ import print_function
 
+import io
 import os
 import time
 import json
-import numpy
+import hashlib
+import logging
+import shutil
 import string
 import threading
-import functools
-import subprocess
 import tempfile
 
 from random import SystemRandom
 choice = lambda seq: SystemRandom().choice(seq)
 
-from collections import defaultdict
+from collections import OrderedDict
 
-from flask import Flask, request, send_file, render_template, jsonify, abort
+from flask import Flask, g, request, send_file, render_template, jsonify, abort, stream_with_context
 from flask.views import View
 from flask_cors import cross_origin
 from werkzeug.utils import secure_filename
 from werkzeug.routing import BaseConverter
-from tempfile import NamedTemporaryFile
+
+import jobs
+import progress
+import job_profile
+import job_events
+import metrics
+from result_cache import result_cache, result_key
+from slice_cache import slice_cache
 
 application = Flask(__name__)
 
+logging.basicConfig(level=os.environ.get("VOXEL_LOG_LEVEL", "WARNING").upper())
+log = logging.getLogger(__name__)
+
 class ColorConverter(BaseConverter):
     @staticmethod
     def to_python(value):
@@ -31,16 +42,47 @@ class ColorConverter(BaseConverter):
             for n in range(len(value)//2):
                 yield int(value[2*n:2*n+2], base=16)
         x = tuple(_())
-        print("COLOR", x)
+        log.debug("color %s", x)
         return x
     @staticmethod
     def to_url(values):
         return ''.join(map(lambda i: hex(i)[0:2], values))
         
+def voxelfile_path(id, num):
+    assert not (set(id) - set(string.ascii_letters))
+    return os.path.join(tempfile.gettempdir(), id, "%d.vox" % int(num))
+
 def get_voxelfile(id, num, lazy=False):
+    db = voxelfile_path(id, num)
+    if lazy:
+        return voxel_storage.load(db, lazy)
+    return voxel_cache.load(db, (id, int(num)))
+
+# id -> (directory mtime, voxel file numbers), see list_voxelfiles()
+voxelfile_listings = OrderedDict()
+voxelfile_listings_lock = threading.Lock()
+
+def list_voxelfiles(id):
+    """
+    Returns the sorted numbers of the voxel files written to a job
+    directory. The listing is cached per job until the directory changes.
+    """
     assert not (set(id) - set(string.ascii_letters))
-    db = os.path.join(tempfile.gettempdir(), id, "%d.vox" % int(num))
-    return voxel_storage.load(db, lazy)
+    d = os.path.join(tempfile.gettempdir(), id)
+    mtime = os.stat(d).st_mtime_ns
+    with voxelfile_listings_lock:
+        cached = voxelfile_listings.get(id)
+        if cached is not None and cached[0] == mtime:
+            voxelfile_listings.move_to_end(id)
+            return cached[1]
+    suffix = ".vox.meta"
+    nums = sorted(int(fn[:-len(suffix)]) for fn in os.listdir(d) if fn.endswith(suffix) and fn[:-len(suffix)].isdigit())
+    with voxelfile_listings_lock:
+        voxelfile_listings[id] = (mtime, nums)
+        voxelfile_listings.move_to_end(id)
+        while len(voxelfile_listings) > 256:
+            voxelfile_listings.popitem(last=False)
+    return nums
 
 application.url_map.converters['color'] = ColorConverter
 
@@ -54,31 +96,72 @@ def run_voxelfile(cwd, id, oncomplete=IDENTITY, args=None):
             else:
                 yield "--%s=%s" % kv
 
+    # number of threads granted from the shared core budget, depending on
+    # the number of jobs that are running (this one included) and queued
+    args = dict(args or {})
+    threads = cores.acquire(sum(job_pool.counts().values()), args.get("threads"))
+    args["threads"] = threads
+
     f = open(os.path.join(cwd, "progress"), "wb")
-    rc = subprocess.call([
-        os.environ.get("VOXEC_EXE") or "voxec", 
-        "-q", "--log-file", "log.json",
-        "voxelfile.txt"
-    ] + list(make_args(args or {})),
-        cwd=cwd, 
-        stdout=f
-    )
+    try:
+        rc, usage = job_profile.run([
+            os.environ.get("VOXEC_EXE") or "voxec", 
+            "-q", "--log-file", "log.json",
+            "voxelfile.txt"
+        ] + list(make_args(args)),
+            cwd=cwd, 
+            stdout=f
+        )
+    finally:
+        cores.release(threads)
     
-    if rc != 0:
-        with open("log.json", "a") as f:
+    voxec_seconds.observe(usage["wall_time"], result="ok" if rc == 0 else "failed")
+    voxec_cpu_seconds.inc(usage["cpu_time"])
+    
+    with open(os.path.join(cwd, "log.json"), "a") as f:
+        json.dump({"severity": "notice", "message": "threads granted: %d" % threads, "threads": threads}, f)
+        f.write("\n")
+        if rc != 0:
             json.dump({"severity": "fatal", "message": "internal error"}, f)
+            f.write("\n")
 
-    oncomplete()
+    try:
+        oncomplete(rc == 0)
+    finally:
+        job_profile.write(cwd, job_profile.create(cwd, usage, args))
+    
+    return rc == 0
+    
+job_pool = jobs.job_queue(int(os.environ.get("VOXEC_WORKERS") or max(1, jobs.cpu_budget() // 2)))
+cores = jobs.core_allocator(jobs.cpu_budget())
+
+results = result_cache(
+    os.path.join(tempfile.gettempdir(), "result_cache"),
+    int(os.environ.get("VOXEL_RESULT_CACHE_BYTES", 1024 * 1024 * 1024))
+)
             
-def dispatch(cwd, id, oncomplete=IDENTITY, args=None):
-    t = threading.Thread(target=run_voxelfile, args=(cwd, id, oncomplete, args))
-    t.start()
+def dispatch(cwd, id, oncomplete=IDENTITY, args=None, priority=1):
+    return job_pool.submit(cwd, id, run_voxelfile, (cwd, id, oncomplete, args), priority)
     
 def dispatch_or_run(asynch, *args):
-    return [run_voxelfile, dispatch][asynch](*args)
+    if asynch:
+        return dispatch(*args)
+    else:
+        # a client is waiting for the result, so it is not queued behind
+        # asynchronous jobs, its cores come from the same budget
+        cwd, id = args[:2]
+        return job_pool.run(cwd, id, run_voxelfile, args)
 
-from visualisation import create_image, image_builder
+from visualisation import create_image, create_image_stack, create_tile, image_builder, pack_plane
+import storage
 from storage import voxel_storage, harmonize
+from storage.cache import storage_cache, file_identity
+from storage.pyramid import plane_pyramid
+
+voxel_cache = storage_cache(
+    max_entries=int(os.environ.get("VOXEL_CACHE_ENTRIES", 32)),
+    max_bytes=int(os.environ.get("VOXEL_CACHE_BYTES", 512 * 1024 * 1024))
+)
 
 @application.route('/2d/<id>/<num>', methods=['GET'])
 @application.route('/2d/<id>/<orientation>/<num>', methods=['GET'])
@@ -91,28 +174,248 @@ def serve_3d(id, num):
     vox = get_voxelfile(id, num)
     return render_template('3d.html', context=id, num=num, chunks=list(vox.numchunks), chunksize=vox.chunksize)
     
+# zlib compression level of slice images, 0 (none) to 9 (smallest)
+PNG_COMPRESS_LEVEL = int(os.environ.get("VOXEL_PNG_COMPRESS_LEVEL", 6))
+
+def image_etag(id, nums, *parts):
+    """
+    Strong ETag of a slice image of job id rendered from the voxel files
+    nums, parts identify the image. The identities of these files are
+    included, so that an image rendered while voxec is still writing them
+    is not served once they change.
+    """
+    files = [(int(n), file_identity(voxelfile_path(id, n))) for n in nums]
+    key = json.dumps([id, parts, files, PNG_COMPRESS_LEVEL])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+slice_images = slice_cache(
+    tempfile.gettempdir(),
+    int(os.environ.get("VOXEL_SLICE_CACHE_BYTES", 64 * 1024 * 1024)),
+    os.environ.get("VOXEL_SLICE_CACHE_PERSIST", "1") != "0",
+    int(os.environ.get("VOXEL_SLICE_CACHE_FILE_BYTES", 1024 * 1024 * 1024))
+)
+
+# Metrics of this process, exposed at /metrics
+registry = metrics.registry()
+request_seconds = registry.histogram("voxel_request_duration_seconds", "Latency of requests by route.", ("route", "method", "status"))
+storage_load_seconds = registry.histogram("voxel_storage_load_seconds", "Time to load a voxel storage from disk.")
+decode_seconds = registry.histogram("voxel_slice_decode_seconds", "Time to decode slices of a chunked voxel storage.")
+contents_bytes = registry.counter("voxel_contents_read_bytes_total", "Bytes read from the .contents memmaps of voxel storages.")
+voxec_seconds = registry.histogram("voxel_voxec_duration_seconds", "Wall time of voxec runs.", ("result",))
+voxec_cpu_seconds = registry.counter("voxel_voxec_cpu_seconds_total", "User and system cpu time of voxec runs.")
+registry.callback("voxel_jobs", "Queued and running jobs.", ("state",),
+    lambda: {(s,): n for s, n in job_pool.counts().items()})
+registry.callback("voxel_jobs_completed_total", "Completed jobs by final state.", ("state",),
+    lambda: {(s,): n for s, n in job_pool.totals.items()}, type="counter")
+
+def cache_stats(keys):
+    caches = (("storage", voxel_cache.stats()), ("slice", slice_images.stats()))
+    return {(c, k): v for c, stats in caches for k, v in stats.items() if k in keys}
+
+registry.callback("voxel_cache_size", "Entries and bytes held by the storage and slice caches.", ("cache", "unit"),
+    lambda: cache_stats({"entries", "bytes", "files", "file_bytes"}))
+registry.callback("voxel_cache_events_total", "Hits, misses and evictions of the storage and slice caches.", ("cache", "event"),
+    lambda: cache_stats({"hits", "file_hits", "misses", "evictions", "file_evictions"}), type="counter")
+
+def observe_storage(name, value):
+    if name == "contents_bytes":
+        contents_bytes.inc(value)
+    elif name == "load_seconds":
+        storage_load_seconds.observe(value)
+    else:
+        decode_seconds.observe(value)
+
+storage.observer = observe_storage
+
+@application.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+
+@application.after_request
+def observe_request(response):
+    # the rule rather than the path, so that ids do not end up in labels
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    request_seconds.observe(time.perf_counter() - g.request_started, route=route, method=request.method, status=response.status_code)
+    return response
+
+@application.route('/metrics', methods=['GET'])
+def get_metrics():
+    return application.response_class(registry.expose(), mimetype="text/plain; version=0.0.4")
+
+def cached_response(id, etag, encode, mimetype):
+    """
+    Responds with the bytes returned by encode(), or 304 Not Modified
+    when the client already has the response with this etag. Slices of
+    finished jobs no longer change and are cached indefinitely.
+    """
+    if request.if_none_match.contains(etag):
+        response = application.response_class(status=304)
+    else:
+        data = slice_images.get(id, etag)
+        if data is None:
+            data = encode()
+            slice_images.put(id, etag, data)
+        response = application.response_class(data, mimetype=mimetype)
+    
+    state = jobs.read_state(os.path.join(tempfile.gettempdir(), id)) or {}
+    if state.get("state") in (jobs.DONE, jobs.FAILED):
+        response.headers['Cache-Control'] = "public, max-age=31536000, immutable"
+    else:
+        response.headers['Cache-Control'] = "no-cache"
+    response.set_etag(etag)
+    return response
+
+def image_response(id, etag, render):
+    def encode():
+        buf = io.BytesIO()
+        render().save(buf, 'PNG', compress_level=PNG_COMPRESS_LEVEL)
+        return buf.getvalue()
+    return cached_response(id, etag, encode, "image/png")
+
 @application.route('/slice/<id>/<num>/<orientation>/<offset>', methods=['GET'])
 def get_slice(id, num, orientation, offset, step="final"):
-    vox = get_voxelfile(id, num)
+    def render():
+        vox = get_voxelfile(id, num)
+        cs = getattr(vox, 'chunksize', -1)
+        return create_image(vox, "xyz".index(orientation), int(offset), grid=cs)
     
-    cs = getattr(vox, 'chunksize', -1)
-    im = create_image(vox, "xyz".index(orientation), int(offset), grid=cs)
+    etag = image_etag(id, [num], "slice", int(num), orientation, int(offset))
+    return image_response(id, etag, render)
     
-    tmp = NamedTemporaryFile(suffix='png')
-    im.save(tmp, 'PNG')
-    tmp.seek(0,0)
+# Width and height of the tiles of /tile in pixels
+TILE_SIZE = 256
+
+# (id, num, axis, offset) -> (file identity, plane_pyramid), see get_pyramid()
+pyramids = OrderedDict()
+pyramids_lock = threading.Lock()
+MAX_PYRAMID_BYTES = int(os.environ.get("VOXEL_TILE_PYRAMID_BYTES", 128 * 1024 * 1024))
+
+def get_pyramid(id, num, vox, axis, offset):
+    """
+    Returns the OR pyramid of a slice, kept for the most recently tiled
+    slices up to MAX_PYRAMID_BYTES, so that its levels are built once.
+    """
+    key = (id, int(num), axis, offset)
+    ident = file_identity(voxelfile_path(id, num))
+    with pyramids_lock:
+        entry = pyramids.get(key)
+        if entry is not None and entry[0] == ident:
+            pyramids.move_to_end(key)
+            pyramid = entry[1]
+        else:
+            pyramid = None
+    if pyramid is None:
+        pyramid = plane_pyramid(vox, axis, offset)
+        with pyramids_lock:
+            pyramids[key] = (ident, pyramid)
+            pyramids.move_to_end(key)
+    with pyramids_lock:
+        # levels are built on first use, so sizes are taken on every
+        # access, the most recently used pyramid is always kept
+        sizes = [(k, e[1].nbytes()) for k, e in pyramids.items()]
+        total = sum(n for _, n in sizes)
+        for k, n in sizes[:-1]:
+            if total <= MAX_PYRAMID_BYTES:
+                break
+            del pyramids[k]
+            total -= n
+    return pyramid
+
+@application.route('/tile/<id>/<num>/<orientation>/<int:offset>/<int:level>/<int:tx>/<int:ty>', methods=['GET'])
+def get_tile(id, num, orientation, offset, level, tx, ty):
+    """
+    A square part of TILE_SIZE pixels of a slice at a level of its OR
+    pyramid, where level k has one pixel per 2**k by 2**k voxels. Tiles
+    are numbered from the top left of the image of create_image(), tiles
+    at the right and bottom are cut off at the end of the slice.
+    """
+    def render():
+        vox = get_voxelfile(id, num)
+        axis = "xyz".index(orientation)
+        if not 0 <= offset < vox.shape[axis]:
+            abort(404)
+        pyramid = get_pyramid(id, num, vox, axis, offset)
+        if level >= pyramid.num_levels():
+            abort(404)
+        
+        w, h = pyramid.level_shape(level)
+        i0, i1 = tx * TILE_SIZE, min((tx + 1) * TILE_SIZE, w)
+        # image rows run from the last to the first plane column
+        j0, j1 = max(h - (ty + 1) * TILE_SIZE, 0), h - ty * TILE_SIZE
+        if i0 >= i1 or j0 >= j1:
+            abort(404)
+        
+        cs = getattr(vox, 'chunksize', -1)
+        # chunk boundaries, as long as these are apart far enough
+        grid = cs >> level if cs >> level >= 4 else -1
+        return create_tile(pyramid.region(level, (i0, j0), (i1, j1)), (i0, j0), grid)
     
-    return send_file(tmp, mimetype="image/png")
+    etag = image_etag(id, [num], "tile", int(num), orientation, offset, level, tx, ty, TILE_SIZE)
+    return image_response(id, etag, render)
+
+@application.route('/bits/<id>/<num>/<orientation>/<int:offset>', methods=['GET'])
+def get_bits(id, num, orientation, offset):
+    """
+    A slice as an occupancy bitmap to be coloured by the client, see
+    pack_plane(), run length encoded with ?encoding=rle.
+    """
+    encoding = request.args.get("encoding", "bits")
+    if encoding not in ("bits", "rle"):
+        abort(400)
+    
+    def encode():
+        vox = get_voxelfile(id, num)
+        axis = "xyz".index(orientation)
+        if not 0 <= offset < vox.shape[axis]:
+            abort(404)
+        cs = getattr(vox, 'chunksize', -1)
+        return pack_plane(vox.slice_range(axis, offset, offset + 1)[0], cs, encoding == "rle")
+    
+    etag = image_etag(id, [num], "bits", int(num), orientation, offset, encoding)
+    return cached_response(id, etag, encode, "application/octet-stream")
+    
+# Upper bound on the number of planes returned by a single /slices request
+MAX_SLICES = 64
+
+@application.route('/slices/<id>/<num>/<orientation>/<int:start>/<int:stop>', methods=['GET'])
+def get_slices(id, num, orientation, start, stop):
+    axis = "xyz".index(orientation)
+    stop = min(stop, start + MAX_SLICES)
+    
+    # the requested range identifies the image together with the file, so
+    # that a revalidation is answered without loading the storage
+    etag = image_etag(id, [num], "slices", int(num), orientation, start, stop)
+    if request.if_none_match.contains(etag):
+        return cached_response(id, etag, None, "image/png")
+    
+    vox = get_voxelfile(id, num)
+    stop = min(stop, vox.shape[axis])
+    if start < 0 or start >= stop:
+        abort(404)
+    
+    def render():
+        cs = getattr(vox, 'chunksize', -1)
+        return create_image_stack(vox.slice_range(axis, start, stop), grid=cs)
+    
+    response = image_response(id, etag, render)
+    # frames are stacked vertically, one per plane from start to stop
+    response.headers['X-Slice-Start'] = str(start)
+    response.headers['X-Slice-Count'] = str(stop - start)
+    return response
     
 @application.route('/count_slice/<id>/<num>/<orientation>/<offset>', methods=['GET'])
 def count_slice(id, num, orientation, offset, step="final"):
     vox = get_voxelfile(id, num)
-    key = [slice(None)] * 3
-    axis = "xyz".index(orientation)
-    key[axis] = int(offset)
-    N = numpy.count_nonzero(vox[tuple(key)])
+    counts = vox.plane_counts("xyz".index(orientation))
+    offset = int(offset)
+    N = int(counts[offset]) if 0 <= offset < len(counts) else 0
     return jsonify({"count": N})
     
+@application.route('/count/<id>/<num>', methods=['GET'])
+def count(id, num):
+    vox = get_voxelfile(id, num)
+    return jsonify({"count": int(vox.plane_counts(2).sum())})
+    
 # Safety barrier example:
 # http://localhost:5000/multi_slice/eeeeee/z/64/4/888888/17/aaaaff/21/ffdddd/23/ff0000
 # More recent ids:
@@ -120,48 +423,45 @@ def count_slice(id, num, orientation, offset, step="final"):
 
 @application.route('/multi_slice/<id>/<color:color>/<orientation>/<offset>/<path:slices>')
 def multi_slice(id, color, orientation, offset, slices):
-    b = image_builder(color)
-    
-    cs = 0
-    
-    parts = slices.split('/')
-    pairs = list(zip(parts[0::2], parts[1::2]))
-    
-    ids = range(100)
-    ids_used = set(int(n) for n, _ in pairs)
-    print("ids_used", ids_used)
-    
-    def get_voxelfile_safe(*args):
-        try:
-            return get_voxelfile(*args)
-        except FileNotFoundError as e:
-            pass        
-    
-    voxs = dict(filter(lambda tup: tup[1] is not None, map(lambda i: (i, get_voxelfile_safe(id, i, i not in ids_used)), ids)))
-    print(voxs)
-    voxs_new = harmonize(voxs.values())
-    voxs = dict(zip(voxs.keys(), voxs_new))
-    
-    for num, clr in pairs:
-        num = int(num)
-        clr = ColorConverter.to_python(clr)
+    def render():
+        b = image_builder(color)
         
-        vox = voxs[num]
-        cs = getattr(vox, 'chunksize', -1)
-        print(type(vox))
+        cs = 0
         
-        b.add(vox, "xyz".index(orientation), int(offset), clr)
+        parts = slices.split('/')
+        pairs = list(zip(parts[0::2], parts[1::2]))
         
-    if cs:
-        b.grid(cs)
+        ids_used = set(int(n) for n, _ in pairs)
+        log.debug("ids used %s", ids_used)
         
-    im = b.image()
-    
-    tmp = NamedTemporaryFile(suffix='png')
-    im.save(tmp, 'PNG')
-    tmp.seek(0,0)
+        # all voxel files of the job take part in the alignment, but for the
+        # ones that are not drawn only the .meta is read
+        voxs = {i: get_voxelfile(id, i, i not in ids_used) for i in list_voxelfiles(id)}
+        log.debug("voxel files %s", voxs)
+        voxs_new = harmonize(voxs.values())
+        voxs = dict(zip(voxs.keys(), voxs_new))
+        
+        for num, clr in pairs:
+            num = int(num)
+            clr = ColorConverter.to_python(clr)
+            
+            vox = voxs[num]
+            cs = getattr(vox, 'chunksize', -1)
+            log.debug("%s %s", num, type(vox).__name__)
+            
+            b.add(vox, "xyz".index(orientation), int(offset), clr)
+            
+        if cs:
+            b.grid(cs)
+            
+        return b.image()
     
-    return send_file(tmp, mimetype="image/png")
+    # all voxel files of the job take part in the alignment, but the ones
+    # not drawn are written once and only their .meta is read, so these
+    # are covered by the listing
+    drawn = sorted(set(int(n) for n in slices.split('/')[0::2]))
+    etag = image_etag(id, drawn, "multi_slice", color, orientation, int(offset), slices, list_voxelfiles(id))
+    return image_response(id, etag, render)
 
 @application.route('/run', methods=['GET'])
 def run_get():
@@ -212,6 +512,17 @@ class voxelfile_base(View):
     
     size = 0.05
     args = {}
+    # output files of a task that are stored in the result cache
+    outputs = ()
+    # layout of buffer.bin, "compact" for the quantized variant, can be
+    # chosen per job with the buffer_format form field
+    buffer_formats = {"default", "compact"}
+    # how buffer.bin is meshed, "voxel" to mesh the voxel storages directly
+    # instead of the OBJ files written by voxec, chosen with the mesher
+    # form field for the tasks that support it
+    meshers = {"obj"}
+    # post-processing stages after voxec, reported by /progress
+    stages = ()
     onbegin = IDENTITY
     oncomplete = IDENTITY
     
@@ -222,23 +533,61 @@ class voxelfile_base(View):
             d = os.path.join(tempfile.gettempdir(), id)
             os.makedirs(d)
             
+            args = {"size": self.size}
+            args.update(self.args)
+            
             file = request.files["ifc"]
+            self.buffer_format = request.form.get("buffer_format", "default")
+            if self.buffer_format not in self.buffer_formats:
+                abort(400)
+            self.mesher = request.form.get("mesher", "obj")
+            if self.mesher not in self.meshers:
+                abort(400)
+            if self.mesher == "voxel":
+                # no OBJ files are written, the meshes are created from
+                # the voxel storages once voxec completes
+                args.pop("mesh", None)
+                self.stages = ("voxel_mesh",)
+                self.command = "".join(l for l in self.command.splitlines(True) if " = mesh(" not in l)
+            self.key = result_key(file.stream, self.command, dict(args, buffer_format=self.buffer_format, mesher=self.mesher))
+            
+            entry = results.restore(self.key, d)
+            if entry is not None:
+                return self.finalize_cached(entry)
+            
             file.save(os.path.join(d, "input.ifc"))
-                
+            
             with open(os.path.join(d, "voxelfile.txt"), "w") as f:
                 f.write(self.command)
                 
-            args = {"size": self.size}
-            args.update(self.args)
-            
+            progress.begin(d, self.stages)
             self.onbegin()
             
-            dispatch_or_run(self.asynch, d, id, self.oncomplete, args)
+            self.state = dispatch_or_run(self.asynch, d, id, self.complete, args)
             
             return self.finalize()
         else:
             return render_template('form.html')
             
+    def statement(self, name):
+        """
+        Number of the voxel storage written for the assignment to name.
+        """
+        return [l.split(" = ")[0] for l in self.command.split("\n")].index(name)
+            
+    def complete(self, succeeded):
+        self.oncomplete()
+        # outputs of a failed or partial run are not cached, so that an
+        # identical upload is processed again
+        if self.outputs and succeeded:
+            d = os.path.join(tempfile.gettempdir(), self.id)
+            results.put(self.key, cwd=d, files=self.outputs)
+            
+    def finalize_cached(self, entry):
+        # the outputs have been placed in the job directory by restore()
+        jobs.write_state(os.path.join(tempfile.gettempdir(), self.id), {"state": jobs.DONE, "cached": True})
+        return self.finalize()
+            
 class scalar_voxelfile_base(voxelfile_base):
     """
     A base view for tasks that result in a numeric measure as output.
@@ -246,20 +595,31 @@ class scalar_voxelfile_base(voxelfile_base):
     
     asynch = False
     
-    def get_result(self, di):
-        if len(di) == 0:
-            # The dictionary is empty when geometry generation
+    def voxel_count(self, num):
+        # the number of voxels in a statement's storage, as in /count
+        return int(get_voxelfile(self.id, num).plane_counts(2).sum())
+    
+    def get_result(self, nums):
+        if len(nums) == 0:
+            # No voxel storages are written when geometry generation
             # failed. In which case, likely the entity types in
             # question were not found. Perhaps we need to handle
             # this differently in subtypes, for now just return
             # zero.
             return 0.
-        last = sorted(map(int, di.keys()))[-1]
-        return int(di.get(last).get('count')) * self.size ** self.dim
+        return self.voxel_count(nums[-1]) * self.size ** self.dim
         
     def finalize(self):
-        di = D.get(self.id).get('dict')
-        return jsonify({self.name: self.get_result(di)})
+        # the storages of a failed run may be incomplete
+        nums = list_voxelfiles(self.id) if self.state == jobs.DONE else []
+        result = self.get_result(nums)
+        if self.state == jobs.DONE:
+            results.put(self.key, value=result)
+        return jsonify({self.name: result})
+        
+    def finalize_cached(self, entry):
+        shutil.rmtree(os.path.join(tempfile.gettempdir(), self.id), ignore_errors=True)
+        return jsonify({self.name: entry["value"]})
         
 class gross_floor_area(scalar_voxelfile_base):
     name = "floor_area"
@@ -297,15 +657,20 @@ surfaces = create_geometry(file)
 voxels = voxelize(surfaces)
 volume = volume2(voxels)
 """
-    def get_result(self, di):
+    def get_result(self, nums):
+        if not {2, 3} <= set(nums):
+            return 0.
         # Count (inner volume) full and surface voxels half
-        surface = int(di.get(2).get('count')) 
-        volume = int(di.get(3).get('count'))
+        surface = self.voxel_count(2)
+        volume = self.voxel_count(3)
         return ((surface // 2) + volume) * self.size ** self.dim
         
 class safety_barriers(voxelfile_base):
     asynch = True    
     name = "safety_barriers"
+    outputs = ("buffer.bin", "data.json")
+    meshers = {"obj", "voxel"}
+    stages = ("prepared_buffer", "annotation_data")
     args = {"mesh": True}
     command = """file = parse("input.ifc")
 surfaces = create_geometry(file, exclude={"IfcOpeningElement", "IfcDoor", "IfcSpace"})
@@ -333,16 +698,29 @@ really_reachable = subtract(reachable_padded, surfaces_obstacle)
 result = intersect(really_reachable, deadly)
 """
 
+    def onbegin(self):
+        import annotation_data
+        # the storey table is extracted while voxec runs
+        annotation_data.start_indexing(os.path.join(tempfile.gettempdir(), self.id))
+
     def oncomplete(self):
         import prepared_buffer
         import annotation_data
         d = os.path.join(tempfile.gettempdir(), self.id)
-        ifc = os.path.join(d, "input.ifc")
         ifn = os.path.join(d, "23.obj")
         ofn1 = os.path.join(d, "buffer.bin")
         ofn2 = os.path.join(d, "data.json")
-        prepared_buffer.create(ifn, ofn1)
-        annotation_data.create(ifc, ifn, ofn2)
+        if self.mesher == "voxel":
+            import voxel_mesh
+            vox = os.path.join(d, "%d.vox" % self.statement("result"))
+            with progress.stage(d, "voxel_mesh"):
+                voxel_mesh.create(ofn1, ofn2, [(vox, 0xff0000ff, True)], annotation_data.load_storeys(d),
+                                  compact=self.buffer_format == "compact", grid=self.size)
+            return
+        with progress.stage(d, "prepared_buffer"):
+            groups, = prepared_buffer.create(ifn, ofn1, compact=self.buffer_format == "compact", grid=self.size)
+        with progress.stage(d, "annotation_data"):
+            annotation_data.create(annotation_data.load_storeys(d), groups, ofn2)
 
     def finalize(self):
         return jsonify({"id": self.id})
@@ -352,6 +730,9 @@ class evacuationroutes(voxelfile_base):
     asynch = True    
     size = 0.1
     name = "evacuation_routes"
+    outputs = ("buffer.bin", "data.json")
+    meshers = {"obj", "voxel"}
+    stages = ("prepared_buffer", "annotation_data")
     args = {"mesh": True}
     command = """file = parse("input.ifc")
 fire_door_filter = filter_attributes(file, OverallWidth=">1.2")
@@ -390,17 +771,33 @@ x = mesh(unsafe, "unsafe.obj")
 x = mesh(safe_interior, "safe.obj")
 """
 
+    def onbegin(self):
+        import annotation_data
+        # the storey table is extracted while voxec runs
+        annotation_data.start_indexing(os.path.join(tempfile.gettempdir(), self.id))
+
     def oncomplete(self):
         import prepared_buffer
         import annotation_data
         d = os.path.join(tempfile.gettempdir(), self.id)
-        ifc = os.path.join(d, "input.ifc")
         ifn1 = os.path.join(d, "safe.obj")
         ifn2 = os.path.join(d, "unsafe.obj")
         ofn1 = os.path.join(d, "buffer.bin")
         ofn2 = os.path.join(d, "data.json")
-        prepared_buffer.create(ofn1, ifn1, '0f0', ifn2, 'f00')
-        annotation_data.create(ifc, ifn2, ofn2)
+        if self.mesher == "voxel":
+            import voxel_mesh
+            inputs = [
+                (os.path.join(d, "%d.vox" % self.statement("safe_interior")), prepared_buffer.color('0f0'), False),
+                (os.path.join(d, "%d.vox" % self.statement("unsafe")), prepared_buffer.color('f00'), True)
+            ]
+            with progress.stage(d, "voxel_mesh"):
+                voxel_mesh.create(ofn1, ofn2, inputs, annotation_data.load_storeys(d),
+                                  compact=self.buffer_format == "compact", grid=self.size)
+            return
+        with progress.stage(d, "prepared_buffer"):
+            _, groups = prepared_buffer.create(ofn1, ifn1, '0f0', ifn2, 'f00', compact=self.buffer_format == "compact", grid=self.size)
+        with progress.stage(d, "annotation_data"):
+            annotation_data.create(annotation_data.load_storeys(d), groups, ofn2)
 
     def finalize(self):
         return jsonify({"id": self.id})
@@ -409,6 +806,7 @@ x = mesh(safe_interior, "safe.obj")
 class accessibility(voxelfile_base):
     asynch = True    
     name = "evacuation_routes"
+    stages = ("get_surfaces", "prepared_buffer")
     args = {"mesh": True}
     command = """file = parse("input.ifc")
 surfaces = create_geometry(file, exclude={"IfcOpeningElement", "IfcDoor", "IfcSpace"})
@@ -442,8 +840,10 @@ void = dump_surfaces(reachable_below, surfaces, "surfaces")
         surfaces = os.path.join(d, "surfaces")
         ofn1 = os.path.join(d, "buffer.bin")
         
-        get_surfaces.get_surfaces(surfaces, ifc)
-        prepared_buffer.create(ifn, ofn1)
+        with progress.stage(d, "get_surfaces"):
+            get_surfaces.get_surfaces(surfaces, ifc)
+        with progress.stage(d, "prepared_buffer"):
+            prepared_buffer.create(ifn, ofn1)
 
     def finalize(self):
         return jsonify({"id": self.id})
@@ -473,17 +873,14 @@ def get_file(check_type, id, part):
 
 
 @application.route('/safetybarriers/<id>/progress')
+@application.route('/evacuationroutes/<id>/progress')
 @cross_origin()
 def get_safetybarriers_progress(id):
     assert not (set(id) - set(string.ascii_letters))
-    d = os.path.join(tempfile.gettempdir(), id)
-    progress = 0
-    for p in os.listdir(d):
-        if p.endswith(".vox.contents"): progress += 5
-    return jsonify({"progress": progress})
-    
+    status = job_status(id)
+    status["progress"] = status["percent"]
+    return jsonify(status)
     
-# TODO: progress for evacuationroutes
     
 application.add_url_rule('/gross_floor_area', methods=['GET', 'POST'], view_func=gross_floor_area.as_view('gross_floor_area'))
 application.add_url_rule('/outer_surface_area', methods=['GET', 'POST'], view_func=outer_surface_area.as_view('outer_surface_area'))
@@ -491,24 +888,114 @@ application.add_url_rule('/volume', methods=['GET', 'POST'], view_func=volume.as
 application.add_url_rule('/safetybarriers/create', methods=['GET', 'POST'], view_func=safety_barriers.as_view('safety_barriers'))
 application.add_url_rule('/evacuationroutes/create', methods=['GET', 'POST'], view_func=evacuationroutes.as_view('evacuationroutes'))
 
+def job_status(id):
+    d = os.path.join(tempfile.gettempdir(), id)
+    # jobs queued by another process are only known through their state file
+    status = job_pool.status(id) or jobs.read_state(d) or {}
+    status.update(progress.report(d, status))
+    return status
+
 @application.route('/progress/<id>', methods=['GET'])
 def get_progress(id):
+    if len(set(id) - set(string.ascii_letters)) != 0:
+        abort(404)
+    d = os.path.join(tempfile.gettempdir(), id)
     try:
-        p = os.path.getsize(os.path.join(tempfile.gettempdir(), id, "progress"))
+        p = os.path.getsize(os.path.join(d, "progress"))
     except: p = 0
-    return jsonify(p)
+    status = job_status(id)
+    status["progress"] = p
+    return jsonify(status)
+    
+# concurrent /events streams per process and the reconnection delay in
+# milliseconds of clients beyond it
+event_streams = threading.BoundedSemaphore(int(os.environ.get("VOXEL_EVENT_STREAMS", 8)))
+EVENT_STREAM_RETRY = 10000
+
+@application.route('/events/<id>', methods=['GET'])
+def get_events(id):
+    """
+    Streams the progress, log entries and state of a job as server-sent
+    events until it completes, see job_events.stream().
+    """
+    if len(set(id) - set(string.ascii_letters)) != 0:
+        abort(404)
+    d = os.path.join(tempfile.gettempdir(), id)
+    if not os.path.isdir(d):
+        abort(404)
+    # a reconnecting client continues where its previous stream ended
+    since = job_events.parse_event_id(request.headers.get("Last-Event-ID"))
+    
+    def events():
+        # every stream holds a server thread, beyond the limit clients
+        # are asked to reconnect later
+        if not event_streams.acquire(blocking=False):
+            yield "retry: %d\n\n" % EVENT_STREAM_RETRY
+            return
+        try:
+            yield from job_events.stream(d, lambda: job_status(id), since)
+        finally:
+            event_streams.release()
     
+    response = application.response_class(
+        stream_with_context(events()),
+        mimetype="text/event-stream"
+    )
+    response.headers['Cache-Control'] = "no-cache"
+    # not buffered by a reverse proxy
+    response.headers['X-Accel-Buffering'] = "no"
+    return response
+    
+# id -> job_events.log_index, see get_log()
+log_indices = OrderedDict()
+log_indices_lock = threading.Lock()
+
 @application.route('/log/<id>', methods=['GET'])
 def get_log(id):
-    lines = []
-    try:
-        with open(os.path.join(tempfile.gettempdir(), id, "log.json")) as f:
-            for l in f:
-                try: lines.append(json.loads(l))
-                except Exception as e: print(e)
-    except EnvironmentError as e:
+    """
+    The entries of the log of a job. With ?since=<offset> only the entries
+    from that byte offset in log.json on, together with the offset of the
+    next entry. Offsets are those returned as next, or 0.
+    """
+    if len(set(id) - set(string.ascii_letters)) != 0:
+        abort(404)
+    fn = os.path.join(tempfile.gettempdir(), id, "log.json")
+    if not os.path.exists(fn):
         abort(503)
-    return jsonify(lines)
+    
+    with log_indices_lock:
+        index = log_indices.get(id)
+        if index is None:
+            index = log_indices[id] = job_events.log_index(fn)
+        log_indices.move_to_end(id)
+        while len(log_indices) > 256:
+            # not closed here, another request may still be reading from
+            # it, the file is closed once the index is garbage collected
+            log_indices.popitem(last=False)
+    
+    since = request.args.get("since", type=int)
+    if since is None and "since" in request.args:
+        abort(400)
+    try:
+        entries, next = index.read(since or 0)
+    except ValueError:
+        abort(400)
+    if since is None:
+        return jsonify(entries)
+    return jsonify({"entries": entries, "next": next})
+
+@application.route('/profile/<id>', methods=['GET'])
+def get_profile(id):
+    """
+    Wall time, cpu time and peak memory of the voxec process of a completed
+    job, with the time spent per statement, see job_profile.create().
+    """
+    if len(set(id) - set(string.ascii_letters)) != 0:
+        abort(404)
+    profile = job_profile.read(os.path.join(tempfile.gettempdir(), id))
+    if profile is None:
+        abort(404)
+    return jsonify(profile)
 
 if __name__ == "__main__":
     application.run(host='0.0.0.0')
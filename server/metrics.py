@@ -0,0 +1,126 @@
+import bisect
+import threading
+
+# Upper bounds in seconds of the histogram buckets, +Inf is implicit
+BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60., 300., 900., 3600.)
+
+
+def format_value(v):
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    escape = lambda s: str(s).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+    return "{%s}" % ",".join("%s=\"%s\"" % (n, escape(v)) for n, v in zip(names, values))
+
+
+class metric(object):
+    """
+    A named metric with values per combination of label values, in the
+    Prometheus text exposition format.
+    """
+
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(str(labels.get(l, "")) for l in self.labels)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, self.labels, k, v) for k, v in sorted(self.values.items())]
+
+    def expose(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.type)]
+        for name, names, values, v in self.samples():
+            lines.append("%s%s %s" % (name, format_labels(names, values), format_value(v)))
+        return "\n".join(lines)
+
+
+class counter(metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        k = self.key(labels)
+        with self.lock:
+            self.values[k] = self.values.get(k, 0) + amount
+
+
+class callback(metric):
+    """
+    A gauge or counter of which the values are obtained from fn() when
+    exposed, as a dict of label value tuples to values, for state that is
+    already tracked elsewhere, such as cache statistics.
+    """
+
+    def __init__(self, name, help, labels=(), fn=dict, type="gauge"):
+        super(callback, self).__init__(name, help, labels)
+        self.fn, self.type = fn, type
+
+    def samples(self):
+        return [(self.name, self.labels, tuple(map(str, k)), v) for k, v in sorted(self.fn().items())]
+
+
+class histogram(metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super(histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        k = self.key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(k)
+            if entry is None:
+                entry = self.values[k] = [[0] * (len(self.buckets) + 1), 0.]
+            entry[0][i] += 1
+            entry[1] += value
+
+    def samples(self):
+        samples = []
+        names = self.labels + ("le",)
+        with self.lock:
+            for k, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for le, n in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += n
+                    samples.append((self.name + "_bucket", names, k + (format_value(le),), cumulative))
+                samples.append((self.name + "_sum", self.labels, k, total))
+                samples.append((self.name + "_count", self.labels, k, cumulative))
+        return samples
+
+
+class registry(object):
+    """
+    The metrics of the process. Metrics are per process, so with multiple
+    gunicorn workers each of them is scraped separately.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, m):
+        self.metrics.append(m)
+        return m
+
+    def counter(self, *args, **kwargs):
+        return self.register(counter(*args, **kwargs))
+
+    def callback(self, *args, **kwargs):
+        return self.register(callback(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(histogram(*args, **kwargs))
+
+    def expose(self):
+        return "\n".join(m.expose() for m in self.metrics) + "\n"
@@ -1,21 +1,232 @@
 import numpy
 
-def signNotZero(f):
-    return 1 if f >= 0. else -1
+# record types of the lines of an obj file
+OTHER, VERTEX, FACE, LINE, GROUP = range(5)
+
+BLOCK_SIZE = 1 << 24
+
+def read_blocks(ifn, block_size=BLOCK_SIZE):
+    """
+    Yields the contents of ifn in blocks of about block_size bytes,
+    every block ending in a newline.
+    """
+    rest = b""
+    with open(ifn, "rb") as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            block = rest + block
+            end = block.rfind(b"\n") + 1
+            rest = block[end:]
+            if end:
+                yield block[:end]
+    if rest:
+        yield rest + b"\n"
+        
+def classify_lines(buf):
+    """
+    Returns the start, end (the newline) and record type of every line
+    in buf, based on the first token of the line.
+    """
+    ends = numpy.flatnonzero(buf == ord("\n"))
+    starts = numpy.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    
+    c0 = buf[starts]
+    c1 = buf[numpy.minimum(starts + 1, len(buf) - 1)]
+    space = c1 == ord(" ")
+    eol = (c1 == ord("\n")) | (c1 == ord("\r"))
+    
+    kinds = numpy.full(len(starts), OTHER, dtype=numpy.uint8)
+    kinds[(c0 == ord("v")) & space] = VERTEX
+    kinds[(c0 == ord("f")) & space] = FACE
+    kinds[(c0 == ord("l")) & space] = LINE
+    kinds[((c0 == ord("o")) | (c0 == ord("g"))) & (space | eol)] = GROUP
+    # as in the line based parser, an empty line also starts a group
+    kinds[(c0 == ord("\n")) | ((c0 == ord("\r")) & eol)] = GROUP
+    
+    return starts, ends, kinds
+    
+def parse_records(buf, starts, ends, mask, dtype):
+    """
+    Parses the numbers on the lines selected by mask into a flat array,
+    for face and line records only the vertex index of every
+    v/vt/vn element is retained.
+    """
+    lengths = ends[mask] - starts[mask] + 1
+    if len(lengths) == 0:
+        return numpy.zeros((0,), dtype=dtype)
+    text = buf[numpy.repeat(mask, ends - starts + 1)]
+    # blank out the record token
+    token = numpy.empty_like(lengths)
+    token[0] = 0
+    numpy.cumsum(lengths[:-1], out=token[1:])
+    text[token] = ord(" ")
+    
+    slash = text == ord("/")
+    if slash.any():
+        # drop everything from a slash up to the next whitespace
+        white = (text == ord(" ")) | (text == ord("\n")) | (text == ord("\r")) | (text == ord("\t"))
+        slashes = numpy.cumsum(slash)
+        word = numpy.cumsum(white)
+        slashes_before_word = numpy.zeros(word[-1] + 1, dtype=slashes.dtype)
+        slashes_before_word[word[white]] = slashes[white]
+        text = text[white | (slashes == slashes_before_word[word])]
+    
+    return numpy.fromstring(text.tobytes(), dtype=dtype, sep=" ")
+    
+def count_records(ifn, block_size=BLOCK_SIZE):
+    """
+    Returns the number of lines of every record type in an obj file,
+    indexed by OTHER, VERTEX, FACE, LINE and GROUP.
+    """
+    counts = numpy.zeros(5, dtype=numpy.int64)
+    for block in read_blocks(ifn, block_size):
+        _, _, kinds = classify_lines(numpy.frombuffer(block, dtype=numpy.uint8))
+        counts += numpy.bincount(kinds, minlength=5)
+    return counts
+    
+def read_obj(ifn, block_size=BLOCK_SIZE, out=None, groups=None):
+    """
+    Reads the vertices, triangle and line indices (zero based) of an obj
+    file. Returns these together with, for every group (o or g) record,
+    the number of triangles, lines and vertices that precede it.
+    
+    The arrays are parsed into out, a preallocated (indices, line_indices,
+    vertices) triple of the sizes given by count_records(). Without out
+    the file is read twice, first to count the records.
+    
+    When groups is a list, it is extended with (name, lowest vertex z
+    coordinate) of every g record, inf without vertices, where a g record
+    extends up to the next one, for annotation_data.create().
+    """
+    if out is None:
+        counts = count_records(ifn, block_size)
+        out = (
+            numpy.empty((counts[FACE], 3), dtype=numpy.uint32),
+            numpy.empty((counts[LINE], 2), dtype=numpy.uint32),
+            numpy.empty((counts[VERTEX], 3), dtype=numpy.float32)
+        )
+    indices, line_indices, vertices = out
+    group_offsets = []
+    names, minima = [], numpy.zeros((0,))
+    
+    nv, nf, nl = 0, 0, 0
+    for block in read_blocks(ifn, block_size):
+        buf = numpy.frombuffer(block, dtype=numpy.uint8)
+        starts, ends, kinds = classify_lines(buf)
+        
+        is_v, is_f, is_l = kinds == VERTEX, kinds == FACE, kinds == LINE
+        
+        g = numpy.flatnonzero(kinds == GROUP)
+        if len(g):
+            before = lambda m: numpy.cumsum(m)[g] - m[g]
+            group_offsets.extend(zip(nf + before(is_f), nl + before(is_l), nv + before(is_v)))
+        
+        v = parse_records(buf, starts, ends, is_v, numpy.float64).reshape((-1, 3))
+        f = parse_records(buf, starts, ends, is_f, numpy.int64).reshape((-1, 3))
+        l = parse_records(buf, starts, ends, is_l, numpy.int64).reshape((-1, 2))
+        assert len(v) == is_v.sum() and len(f) == is_f.sum() and len(l) == is_l.sum()
+        
+        if groups is not None:
+            # minimum over the unrounded coordinates, as parsed
+            is_g = numpy.zeros(len(kinds), dtype=bool)
+            is_g[g] = [buf[s] == ord("g") and buf[s + 1] == ord(" ") for s in starts[g]]
+            named = numpy.flatnonzero(is_g)
+            names.extend(bytes(buf[s:e]).strip().split(b" ")[1].decode("utf-8") for s, e in zip(starts[named], ends[named]))
+            minima = numpy.concatenate((minima, numpy.full(len(named), numpy.inf)))
+            group = len(names) - len(named) - 1 + numpy.cumsum(is_g)[is_v]
+            within = group >= 0
+            numpy.minimum.at(minima, group[within], v[within, 2])
+        
+        vertices[nv:nv + len(v)] = v
+        indices[nf:nf + len(f)] = f - 1
+        line_indices[nl:nl + len(l)] = l - 1
+        nv, nf, nl = nv + len(v), nf + len(f), nl + len(l)
+    
+    if groups is not None:
+        groups.extend(zip(names, map(float, minima)))
+    
+    return indices, line_indices, vertices, [tuple(map(int, x)) for x in group_offsets]
+
+# object table entry of the prepared buffer
+OBJECT = numpy.dtype([
+    ("oid", numpy.int64),
+    ("index", numpy.int32, (7,)),
+    ("density", numpy.float32),
+    ("colors", numpy.uint32, (3,))
+])
+
+# object table entry of the compact prepared buffer
+COMPACT_OBJECT = numpy.dtype([
+    ("oid", numpy.int64),
+    ("index", numpy.int32, (6,)),
+    ("density", numpy.float32),
+    ("colors", numpy.uint32, (3,))
+])
+
+def compute_normals(indices, vertices, quads=True):
+    """
+    Computes per vertex normals, snapped to the signs of the face normal
+    components. With quads every pair of consecutive triangles is a quad
+    and takes the normal of its first triangle. A vertex shared by
+    multiple triangles takes the normal of the last one.
+    """
+    # initialize to (0,0,1) in case we fail to calculate normals (e.g. in case of line vertices)
+    normals = numpy.zeros(vertices.shape, dtype=numpy.float32)
+    normals[:,2] = 1.
+    
+    if len(indices) == 0:
+        return normals
+    
+    tri_vs = vertices[indices[::2] if quads else indices]
+    c = numpy.cross(tri_vs[:,1] - tri_vs[:,0], tri_vs[:,2] - tri_vs[:,0])
+    # no sqrt
+    # c /= numpy.linalg.norm(c)
+    c = numpy.copysign(numpy.abs(c) > 0.001, c)
+    if quads:
+        c = numpy.repeat(c, 2, axis=0)[:len(indices)]
+    
+    # position of the last reference to every vertex
+    flat = indices.reshape(-1)
+    last = len(flat) - 1 - numpy.unique(flat[::-1], return_index=True)[1]
+    normals[flat[last]] = c[last // 3]
+    return normals
 
 def normalToOct(normal):
-    x = sum(numpy.abs(normal))
-    p = normal[0:2] / x
-    if normal[2] <= 0.:
-        a = (1. - numpy.abs(p[0])) * signNotZero(p[0])
-        b = (1. - numpy.abs(p[1])) * signNotZero(p[1])
-        p[:] = a, b
+    return normalsToOct(numpy.asarray(normal, dtype=numpy.float64)[None])[0]
+
+def normalsToOct(normals):
+    """
+    Octahedral encoding of an (n, 3) array of normals into (n, 2) bytes.
+    The lower hemisphere is folded with the components swapped, as in the
+    usual octahedral decoders.
+    """
+    x = numpy.abs(normals).sum(axis=1)
+    x[x == 0.] = 1.
+    p = normals[:,0:2] / x[:,None]
+    lower = normals[:,2] <= 0.
+    sign = numpy.where(p[lower] >= 0., 1., -1.)
+    p[lower] = (1. - numpy.abs(p[lower][:,::-1])) * sign
     return numpy.int8(p * 127.)
 
+def color(s):
+    if len(s) == 3:
+        r, g, b = s;
+        s = "".join((b, b, g, g, r, r))
+    if len(s) == 6:
+        s = "ff" + s
+    return int(s, 16)
+
 # ifn, ofn
 # or
-# ofn, ifn0, color0, iffn1, color1, ...    
-def create(*args):
+# ofn, ifn0, color0, iffn1, color1, ...
+# quads=False when the triangles are not emitted as pairs forming quads
+# compact=True for the quantized layout, with positions on a grid of size
+# returns the (name, lowest z) groups of every input, see read_obj()
+def create(*args, quads=True, compact=False, grid=0.05):
     if len(args) == 2:
         ifn, ofn = args
         input_pairs = [[ifn, 0xff0000ff]]
@@ -23,193 +234,267 @@ def create(*args):
         ofn = args[0]
         rest = args[1:]
         assert len(rest) % 2 == 0
-        def color(s):
-            if len(s) == 3:
-                r, g, b = s;
-                s = "".join((b, b, g, g, r, r))
-            if len(s) == 6:
-                s = "ff" + s
-            return int(s, 16)
         input_pairs = zip(rest[::2], map(color, rest[1::2]))        
         
-    index_count, line_index_count, vertex_count = 0, 0, 0
+    input_pairs = list(input_pairs)
+    
+    """
+    =========================
+    Prepared Buffer Structure
+    =========================
+
+    nrObjects      : int
+    nrIndices      : int
+    (nrLineIndices): 0
+    positionsIndex : int
+    normalsIndex   : int
+    colorsIndex    : int
+
+    align8
+
+    nrObjects      : int
+    totalNrIndices : int
+    (nrLineIndices): 0
+    positionsIndex : int
+    normalsIndex   : int
+    colorsIndex    : int
+
+    indices        : array<int, totalNrIndices>
+    lineIndices    : array<int, nrLineIndices>
+
+    objects : array<struct, nrObjects>
+        oid           : long
+        startIndex    : int
+        (startLI)     : 0
+        nrIndices     : int
+        (nrLI)        : 0
+        nrVertices    : int
+        minIndex      : int
+        maxIndex      : int
+        density       : float
+        colorPackSize : int
+
+        colorpack : array<struct, colorPackSize>
+            count : int
+            color : array<ubyte, 4>
+            
+        positions : vec<float | short, positionsIndex>
+        normals   : vec<byte, normalsIndex>
+      
+    """
+    
+    # All inputs are sized first, so that they can be parsed directly
+    # into their regions of the output.
+    counts = [list(map(int, count_records(ifn))) for ifn, _ in input_pairs]
+    nv, nf, nl, ng = (sum(c[k] for c in counts) for k in (VERTEX, FACE, LINE, GROUP))
+    
+    regions, mm = allocate(ofn, nv, nf, nl, ng, compact)
+    
     offsets = []
-    line_offsets = []
-    indices_np_total, line_indices_np_total, vertices_np_total, normals_np_total = None, None, None, None
+    groups = []
+    vb, fb, lb = 0, 0, 0
+    
+    for (ifn, clr), c in zip(input_pairs, counts):
+        indices_np = regions["indices"][fb:fb + c[FACE]]
+        line_indices_np = regions["line_indices"][lb:lb + c[LINE]]
+        vertices_np = regions["vertices"][vb:vb + c[VERTEX]]
+        
+        groups.append([])
+        _, _, _, group_offsets = read_obj(ifn, out=(indices_np, line_indices_np, vertices_np), groups=groups[-1])
+        
+        for f, _, v in group_offsets:
+            offsets.append([(fb + f) * 3, (vb + v) * 3, clr])
+        
+        regions["normals"][vb:vb + c[VERTEX]] = encode_normals(compute_normals(indices_np, vertices_np, quads), compact)
+        
+        indices_np += vb
+        line_indices_np += vb
+        
+        vb, fb, lb = vb + c[VERTEX], fb + c[FACE], lb + c[LINE]
+    
+    finish(ofn, regions, mm, offsets, compact, grid)
+    
+    return groups
 
-    with open(ofn, "wb") as f:
+def allocate(ofn, nv, nf, nl, ng, compact=False):
+    """
+    Allocates the regions (header, indices, line_indices, objects,
+    vertices, normals) of a prepared buffer for the given number of
+    vertices, triangles, lines and objects. For the default layout these
+    are views into the memory mapped output file, which is returned as
+    well, the compact layout is written from in memory arrays.
+    """
+    header = numpy.array([ng, nf * 3, nl * 2, nv * 3, nv * 3, 0], dtype=numpy.int32)
     
-        index_offset = 0
-    
-        for ifn, clr in input_pairs:
-            # print(ifn, hex(clr))
-        
-            indices, line_indices, vertices = [], [], []
-        
-            for l in open(ifn):
-                args = l.strip().split(" ")
-                a = args[0]
-                bs = args[1:]
-
-                if a == "v":
-                    vertices.extend(map(float, bs))
-                    vertex_count += 3
-                elif a == "f":
-                    assert len(bs) == 3
-                    indices.extend(map(lambda s: int(s.split("/")[0]), bs))
-                    index_count += 3
-                elif a == "l":
-                    assert len(bs) == 2
-                    line_indices.extend(map(lambda s: int(s.split("/")[0]), bs))
-                    line_index_count += 2
-                elif a in "og":
-                    # if bs == ["component1"]: break
-                    
-                    offsets.append([index_count, vertex_count, clr])
-                    line_offsets.append([line_index_count, vertex_count, clr])
-                    
-            indices_np = numpy.array(indices, dtype=numpy.uint32).reshape((-1, 3)) - 1
-            line_indices_np = numpy.array(line_indices, dtype=numpy.uint32).reshape((-1, 2)) - 1
-            vertices_np = numpy.array(vertices, dtype=numpy.float32).reshape((-1, 3))
-            
-            indices[:] = []
-            line_indices[:] = []
-            vertices[:] = []
-            
-            # initialize to (0,0,1) in case we fail to calculate normals (e.g. in case of line vertices)
-            normals = numpy.zeros(vertices_np.shape, dtype=numpy.float32)
-            normals[:,2] = 1.
-            
-            n = 0
-            for idxs in indices_np:
-                if n % 2 == 0:
-                    # We use the fact that in our case of voxels always quads are emitted
-                    tri_vs = vertices_np[idxs]
-                    e0, e1 = tri_vs[1:] - tri_vs[0]
-                    c = numpy.cross(e0, e1)
-                    # no sqrt
-                    # c /= numpy.linalg.norm(c)
-                    c = numpy.copysign(numpy.abs(c) > 0.001, c)
-                for id in idxs:
-                    normals[id] = c
-                n += 1
-
-            """
-            =========================
-            Prepared Buffer Structure
-            =========================
-
-            nrObjects      : int
-            nrIndices      : int
-            (nrLineIndices): 0
-            positionsIndex : int
-            normalsIndex   : int
-            colorsIndex    : int
-
-            align8
-
-            nrObjects      : int
-            totalNrIndices : int
-            (nrLineIndices): 0
-            positionsIndex : int
-            normalsIndex   : int
-            colorsIndex    : int
-
-            indices        : array<int, totalNrIndices>
-            lineIndices    : array<int, nrLineIndices>
-
-            objects : array<struct, nrObjects>
-                oid           : long
-                startIndex    : int
-                (startLI)     : 0
-                nrIndices     : int
-                (nrLI)        : 0
-                nrVertices    : int
-                minIndex      : int
-                maxIndex      : int
-                density       : float
-                colorPackSize : int
-
-                colorpack : array<struct, colorPackSize>
-                    count : int
-                    color : array<ubyte, 4>
-                    
-                positions : vec<float | short, positionsIndex>
-                normals   : vec<byte, normalsIndex>
-              
-            """
-            
-            if indices_np_total is None:
-                indices_np_total = indices_np
-                line_indices_np_total = line_indices_np
-                vertices_np_total = vertices_np
-                normals_np_total = normals
-            else:
-                indices_np += index_offset
-                line_indices_np += index_offset
-                
-                indices_np_total = numpy.vstack((indices_np_total, indices_np))
-                line_indices_np_total = numpy.vstack((line_indices_np_total, line_indices_np))
-                vertices_np_total = numpy.vstack((vertices_np_total, vertices_np))
-                normals_np_total = numpy.vstack((normals_np_total, normals))
-                
-            index_offset += vertices_np.shape[0]
-                
-        # print([len(offsets), indices_np_total.size, line_indices_np_total.size, vertices_np_total.size, normals_np_total.size, 0])
-        # print(offsets)
-        
-        numpy.array([len(offsets), indices_np_total.size, line_indices_np_total.size, vertices_np_total.size, normals_np_total.size, 0], dtype=numpy.int32).tofile(f)
-        # alignment not necessary anymore
-        # numpy.array([0], dtype=numpy.int32).tofile(f)
-        numpy.array([len(offsets), indices_np_total.size, line_indices_np_total.size, vertices_np_total.size, normals_np_total.size, 0], dtype=numpy.int32).tofile(f)        
-        
-        indices_np_total.tofile(f)
-        line_indices_np_total.tofile(f)
-        
-        nrColors = vertices_np_total.size * 4 // 3
-        iVerts = 0
-        iColors = 0
-        
-        for i, (off, voff, clr) in enumerate(offsets):
-            # nb OID set to zero, assign in viewer
-            numpy.array([0], dtype=numpy.int64).tofile(f)
-            try:
-                next, vnext, _ = offsets[i+1]
-            except IndexError as e:
-                next = indices_np_total.size
-                vnext = vertices_np_total.size
-            off //= 3
-            next //= 3
-            
-            min_index, max_index = indices_np_total[off:next].min(), indices_np_total[off:next].max()
-            
-            iVerts += vnext - voff
-            iColors += (vnext - voff) // 3 * 4
-            
-            vs = vertices_np_total[min_index:max_index+1]
-            # print(hex(clr))
-            # print("i", off, "-", next)
-            # print("v", min_index, "-" , max_index)
-            # print(numpy.min(vs, axis=0))
-            # print(numpy.max(vs, axis=0))
-            
-            numpy.array([off, 0, next - off, 0, vnext - voff, min_index, max_index], dtype=numpy.int32).tofile(f)
-            numpy.array([0.], dtype=numpy.float32).tofile(f)
-            numpy.array([1, (vnext - voff) // 3 * 4, clr], dtype=numpy.uint32).tofile(f)
-            
-        assert iColors == nrColors
+    layout = [
+        ("header", numpy.int32, (2, 6)),
+        ("indices", numpy.uint32, (nf, 3)),
+        ("line_indices", numpy.uint32, (nl, 2)),
+        ("objects", OBJECT, (ng,)),
+        ("vertices", numpy.float32, (nv, 3)),
+        ("normals", numpy.int8, (nv, 3))
+    ]
+    size = sum(numpy.dtype(dt).itemsize * int(numpy.prod(shape)) for _, dt, shape in layout)
+    
+    mm = None
+    if compact:
+        regions = {name: numpy.empty(shape, dtype=dt) for name, dt, shape in layout}
+    else:
+        mm = numpy.memmap(ofn, dtype=numpy.uint8, mode="w+", shape=(size,))
+        regions = {}
+        start = 0
+        for name, dt, shape in layout:
+            n = numpy.dtype(dt).itemsize * int(numpy.prod(shape))
+            regions[name] = mm[start:start + n].view(dt).reshape(shape)
+            start += n
         
+    # alignment not necessary anymore, the header is written twice
+    regions["header"][:] = header
+    
+    return regions, mm
+    
+def encode_normals(normals, compact=False):
+    # Normals no longer oct encoded, except in the compact layout
+    # for n in normals.reshape((-1, 3)):
+    #     normalToOct(n).tofile(f)
+    if compact:
+        encoded = numpy.zeros(normals.shape, dtype=numpy.int8)
+        encoded[:,0:2] = normalsToOct(normals)
+        return encoded
+    else:
+        return numpy.int8(normals * 128)
+    
+def finish(ofn, regions, mm, offsets, compact=False, grid=0.05):
+    """
+    Fills the object table from offsets, [index offset, vertex offset,
+    color] of the first triangle and vertex of every object, and writes
+    the prepared buffer.
+    """
+    nf, nv = len(regions["indices"]), len(regions["vertices"])
+    
+    if offsets:
+        off, voff, clr = numpy.array(offsets, dtype=numpy.int64).T
+        next = numpy.append(off[1:], nf * 3) // 3
+        vnext = numpy.append(voff[1:], nv * 3)
+        off //= 3
+        
+        # min and max index per object, objects without triangles get 0
+        min_index = numpy.zeros(len(off), dtype=numpy.int64)
+        max_index = numpy.zeros(len(off), dtype=numpy.int64)
+        nonempty = next > off
+        if nonempty.any():
+            flat = regions["indices"].reshape(-1)
+            min_index[nonempty] = numpy.minimum.reduceat(flat, off[nonempty] * 3)
+            max_index[nonempty] = numpy.maximum.reduceat(flat, off[nonempty] * 3)
+        
+        nrColors = (vnext - voff) // 3 * 4
+        assert nrColors.sum() == nv * 4
+        
+        objects = regions["objects"]
+        # nb OID set to zero, assign in viewer
+        objects["oid"] = 0
+        objects["index"] = numpy.stack([off, 0 * off, next - off, 0 * off, vnext - voff, min_index, max_index], axis=1)
+        objects["density"] = 0.
+        objects["colors"] = numpy.stack([numpy.ones_like(off), nrColors, clr], axis=1)
+    
+    if compact:
+        write_compact(ofn, regions, grid)
+    else:
         # dequantization happens in the client now for annotations
         # (numpy.int16(vertices_np_total / 0.05) * 100).tofile(f)
         
         # Viewer expect millimeters
-        (vertices_np_total * 1000.).tofile(f)
-        
-        # Normals no longer oct encoded
-        # for n in normals.reshape((-1, 3)):
-        #     normalToOct(n).tofile(f)
+        regions["vertices"] *= 1000.
+        mm.flush()
+
+COMPACT_VERSION = 2
+
+def write_compact(ofn, regions, grid):
+    """
+    Writes the compact variant of the prepared buffer, the last header
+    field (0 in the default layout) holds the layout version.
+    
+    ======================================
+    Compact Prepared Buffer Structure (v2)
+    ======================================
+
+    nrObjects      : int
+    nrIndices      : int
+    nrLineIndices  : int
+    positionsIndex : int
+    normalsIndex   : int      (2 components per vertex)
+    version        : int      (2)
+
+    (header repeated)
+
+    quantization   : float    (metres per position unit)
+    origin         : vec<float, 3>
+
+    objects : array<struct, nrObjects>
+        oid           : long
+        startIndex    : int   (byte offset into indices)
+        indexSize     : int   (2 or 4)
+        nrIndices     : int
+        nrVertices    : int
+        minIndex      : int
+        maxIndex      : int
+        density       : float
+        colorPackSize : int
+
+        colorpack : array<struct, colorPackSize>
+            count : int
+            color : array<ubyte, 4>
+
+    indices     : per object, ushort relative to minIndex when the object
+                  spans less than 65536 vertices, otherwise int, padded
+                  to 4 bytes
+    lineIndices : array<int, nrLineIndices>
+    positions   : vec<short, positionsIndex>, origin + position * quantization, padded to 4 bytes
+    normals     : vec<byte, normalsIndex>, oct encoded
+    """
+    
+    vertices = regions["vertices"]
+    objects = regions["objects"]
+    
+    if len(vertices):
+        origin = vertices.min(axis=0)
+        positions = numpy.round((vertices - origin) / grid)
+        if positions.max() > numpy.iinfo(numpy.int16).max:
+            raise ValueError("Model extent exceeds the int16 range at grid size %s" % grid)
+    else:
+        origin = numpy.zeros(3, dtype=numpy.float32)
+        positions = numpy.zeros((0, 3))
+    
+    flat = regions["indices"].reshape(-1)
+    index_parts = []
+    entries = numpy.zeros(len(objects), dtype=COMPACT_OBJECT)
+    start = 0
+    for i, o in enumerate(objects):
+        off, _, n, _, nverts, lo, hi = map(int, o["index"])
+        indices = flat[off * 3:(off + n) * 3]
+        if hi - lo < 65536:
+            data = (indices - lo).astype(numpy.uint16).tobytes()
+            size = 2
+        else:
+            data = indices.astype(numpy.uint32).tobytes()
+            size = 4
+        data += b"\0" * (-len(data) % 4)
+        index_parts.append(data)
+        entries[i] = (0, (start, size, n * 3, nverts, lo, hi), 0., (1, o["colors"][1], o["colors"][2]))
+        start += len(data)
         
-        numpy.int8(normals_np_total * 128).tofile(f)
+    header = numpy.array([len(objects), flat.size, regions["line_indices"].size, positions.size, len(vertices) * 2, COMPACT_VERSION], dtype=numpy.int32)
+    
+    with open(ofn, "wb") as f:
+        f.write(numpy.stack([header, header]).tobytes())
+        f.write(numpy.array([grid], dtype=numpy.float32).tobytes())
+        f.write(numpy.float32(origin).tobytes())
+        f.write(entries.tobytes())
+        f.write(b"".join(index_parts))
+        f.write(regions["line_indices"].tobytes())
+        data = numpy.int16(positions).tobytes()
+        f.write(data + b"\0" * (-len(data) % 4))
+        f.write(numpy.ascontiguousarray(regions["normals"][:,0:2]).tobytes())
 
 if __name__ == "__main__":
     import sys
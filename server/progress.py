@@ -0,0 +1,197 @@
+import os
+import re
+import copy
+import json
+import time
+import threading
+
+from collections import OrderedDict
+
+import jobs
+
+# Post-processing stages are persisted in the job directory under this name
+STATE_FILE = "progress.json"
+
+# voxelfile operations that do not result in a voxel storage, the other
+# statements are written by voxec to <statement number>.vox
+VOID_OPERATIONS = {"parse", "filter_attributes", "create_geometry", "count", "mesh", "dump_surfaces"}
+
+STATEMENT = re.compile(r"^\s*(\w+)\s*=\s*(\w+)\s*\(")
+
+
+def statements(command):
+    """
+    The statements of a voxelfile as (number, variable, operation,
+    whether it results in a voxel storage), numbered by line as voxec
+    numbers its outputs.
+    """
+    for i, l in enumerate(command.split("\n")):
+        m = STATEMENT.match(l)
+        if m:
+            yield i, m.group(1), m.group(2), m.group(2) not in VOID_OPERATIONS
+
+
+def read_state(cwd):
+    try:
+        with open(os.path.join(cwd, STATE_FILE)) as f:
+            return json.load(f)
+    except (EnvironmentError, ValueError):
+        return {"stages": []}
+
+
+def begin(cwd, stages=()):
+    """
+    Registers the post-processing stages that follow voxec for a job.
+    """
+    jobs.write_state(cwd, {"stages": [{"name": s, "started": None, "finished": None} for s in stages]}, STATE_FILE)
+
+
+class stage(object):
+    """
+    Context manager that records the start and end of a post-processing
+    stage of the job in directory cwd.
+    """
+
+    def __init__(self, cwd, name):
+        self.cwd, self.name = cwd, name
+
+    def update(self, **kwargs):
+        state = read_state(self.cwd)
+        entry = next((s for s in state["stages"] if s["name"] == self.name), None)
+        if entry is None:
+            entry = {"name": self.name, "started": None, "finished": None}
+            state["stages"].append(entry)
+        entry.update(kwargs)
+        jobs.write_state(self.cwd, state, STATE_FILE)
+
+    def __enter__(self):
+        self.update(started=time.time())
+        return self
+
+    def __exit__(self, *args):
+        self.update(finished=time.time())
+
+
+def changes(cwd, job):
+    """
+    What the progress of the job in directory cwd depends on while it
+    runs: the voxec stdout and log, which grow as statements complete,
+    the post-processing stages and the job state.
+    """
+    def identity(name):
+        try:
+            st = os.stat(os.path.join(cwd, name))
+        except EnvironmentError:
+            return None
+        return st.st_size, st.st_mtime_ns
+    return identity("progress"), identity("log.json"), identity(STATE_FILE), job.get("state"), job.get("started")
+
+
+# cwd -> [statements, changes(), report, running steps], see report()
+reports = OrderedDict()
+reports_lock = threading.Lock()
+MAX_REPORTS = 256
+
+
+def report(cwd, job=None):
+    """
+    Progress of the job in directory cwd, as the percentage of steps
+    done, the current step and the steps with their elapsed time. The
+    steps are the statements of the voxelfile followed by the post-
+    processing stages. A statement is done once its .vox output exists,
+    statements without output are done with the next one that has, so
+    their time is included in that step. job is the job state, see
+    jobs.job.to_dict().
+    
+    The report is kept per job and only computed again when changes()
+    does, only the elapsed time of the running step is updated.
+    """
+    job = job or {}
+    key = changes(cwd, job)
+
+    with reports_lock:
+        entry = reports.get(cwd)
+        if entry is not None:
+            reports.move_to_end(cwd)
+    if entry is None:
+        try:
+            with open(os.path.join(cwd, "voxelfile.txt")) as f:
+                entry = [list(statements(f.read())), None, None, None]
+        except EnvironmentError:
+            entry = [[], None, None, None]
+
+    if entry[1] != key:
+        entry[2], entry[3] = compute_report(cwd, job, entry[0])
+        entry[1] = key
+        if entry[0]:
+            # written before the job is queued, but the job may be cached
+            # without a voxelfile
+            with reports_lock:
+                reports[cwd] = entry
+                while len(reports) > MAX_REPORTS:
+                    reports.popitem(last=False)
+
+    result = copy.deepcopy(entry[2])
+    now = time.time()
+    for i, since in entry[3]:
+        result["steps"][i]["elapsed"] = now - since
+    return result
+
+
+def compute_report(cwd, job, statements):
+    """
+    The report of report(), and (step index, start time) of the steps
+    that are running.
+    """
+    started = job.get("started")
+
+    steps = []
+    running = []
+    pending = []
+    previous = started
+    for number, variable, operation, voxels in statements:
+        step = {"step": "%s = %s" % (variable, operation), "number": number, "operation": operation, "state": "pending", "elapsed": None, "finished": None}
+        steps.append(step)
+        pending.append(step)
+        if not voxels:
+            continue
+        try:
+            finished = os.path.getmtime(os.path.join(cwd, "%d.vox.contents" % number))
+        except EnvironmentError:
+            continue
+        for s in pending:
+            s["state"] = "done"
+        step["elapsed"] = finished - previous if previous else None
+        step["finished"] = finished
+        previous = finished
+        pending = []
+
+    for s in read_state(cwd)["stages"]:
+        state = "done" if s["finished"] else "running" if s["started"] else "pending"
+        steps.append({"step": s["name"], "state": state, "elapsed": s["finished"] - s["started"] if s["finished"] else None})
+        if state == "running":
+            running.append((len(steps) - 1, s["started"]))
+        if state != "pending":
+            # statements without output at the end of the voxelfile
+            for p in pending:
+                p["state"] = "done"
+            pending = []
+
+    if job.get("state") == jobs.DONE:
+        for s in steps:
+            s["state"] = "done"
+        running = []
+
+    current = next((s for s in steps if s["state"] != "done"), None)
+    if current is not None and current["state"] == "pending" and job.get("state") == jobs.RUNNING:
+        current["state"] = "running"
+        if current.get("number") is not None and (previous or started):
+            running.append((steps.index(current), previous or started))
+
+    done = sum(1 for s in steps if s["state"] == "done")
+    return {
+        # cached results are done without steps
+        "percent": 100. if job.get("state") == jobs.DONE else 100. * done / len(steps) if steps else 0.,
+        "step": current["step"] if current else None,
+        "steps": steps
+    }, running
@@ -0,0 +1,100 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+
+def result_key(stream, command, args):
+    """
+    Content hash of an IFC upload, the voxelfile and the arguments passed
+    to voxec. The stream is read to the end and rewound.
+    """
+    h = hashlib.sha256()
+    for block in iter(lambda: stream.read(1 << 20), b""):
+        h.update(block)
+    stream.seek(0)
+    h.update(b"\0" + command.encode("utf-8"))
+    h.update(b"\0" + json.dumps(args, sort_keys=True).encode("utf-8"))
+    return h.hexdigest()
+
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class result_cache(object):
+    """
+    An on-disk cache of task results keyed by result_key(). An entry is a
+    directory with an entry.json holding the scalar result, if any, and
+    hard links to (or copies of) the output files of the job. Entries are
+    evicted least recently used first when the files exceed max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def get(self, key):
+        d = os.path.join(self.directory, key)
+        try:
+            with open(os.path.join(d, "entry.json")) as f:
+                entry = json.load(f)
+        except (EnvironmentError, ValueError):
+            return None
+        if not all(os.path.exists(os.path.join(d, fn)) for fn in entry["files"]):
+            return None
+        # the entry's mtime orders the entries for eviction
+        os.utime(os.path.join(d, "entry.json"))
+        return entry
+
+    def restore(self, key, cwd):
+        """
+        Places the output files of a cached entry in job directory cwd,
+        returns None if there is no such entry.
+        """
+        d = os.path.join(self.directory, key)
+        entry = self.get(key)
+        if entry is None:
+            return None
+        for fn in entry["files"]:
+            link_or_copy(os.path.join(d, fn), os.path.join(cwd, fn))
+        return entry
+
+    def put(self, key, value=None, cwd=None, files=()):
+        d = os.path.join(self.directory, key)
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix=key + ".", suffix=".tmp", dir=self.directory)
+        try:
+            for fn in files:
+                link_or_copy(os.path.join(cwd, fn), os.path.join(tmp, fn))
+            with open(os.path.join(tmp, "entry.json"), "w") as f:
+                json.dump({"value": value, "files": list(files)}, f)
+            # directories are renamed into place, so that concurrent
+            # readers never see a partial entry
+            os.rename(tmp, d)
+        except OSError:
+            # an entry for the same key was stored concurrently
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for key in os.listdir(self.directory):
+            d = os.path.join(self.directory, key)
+            try:
+                mtime = os.path.getmtime(os.path.join(d, "entry.json"))
+                size = sum(os.path.getsize(os.path.join(d, fn)) for fn in os.listdir(d))
+            except EnvironmentError:
+                continue
+            entries.append((mtime, size, d))
+        total = sum(e[1] for e in entries)
+        for mtime, size, d in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(d, ignore_errors=True)
+            total -= size
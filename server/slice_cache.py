@@ -0,0 +1,129 @@
+import os
+import logging
+import tempfile
+import threading
+
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+# Encoded slices are stored in the job directory under this name
+SLICE_DIR = "slices"
+
+
+class slice_cache(object):
+    """
+    An LRU cache of encoded slice images keyed by job id and ETag, which
+    covers all request parameters. Entries are held in memory up to
+    max_bytes per process. With persist, images are also written to the
+    job directory, where the other gunicorn workers of the host find
+    them. The files written or read by a process are deleted, least
+    recently used first, beyond max_file_bytes.
+    """
+
+    def __init__(self, directory, max_bytes, persist=True, max_file_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.persist = persist
+        self.max_file_bytes = max_bytes * 16 if max_file_bytes is None else max_file_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        # persisted images by path -> size
+        self.files = OrderedDict()
+        self.file_nbytes = 0
+        self.hits = self.file_hits = self.misses = self.evictions = self.file_evictions = 0
+        self.lock = threading.Lock()
+
+    def path(self, id, etag):
+        return os.path.join(self.directory, id, SLICE_DIR, etag)
+
+    def get(self, id, etag):
+        with self.lock:
+            data = self.entries.get((id, etag))
+            if data is not None:
+                self.entries.move_to_end((id, etag))
+                self.hits += 1
+                return data
+
+        if self.persist:
+            try:
+                with open(self.path(id, etag), "rb") as f:
+                    data = f.read()
+            except EnvironmentError:
+                pass
+            else:
+                with self.lock:
+                    self.file_hits += 1
+                self._insert((id, etag), data)
+                self._track(self.path(id, etag), len(data))
+                return data
+
+        with self.lock:
+            self.misses += 1
+
+    def put(self, id, etag, data):
+        self._insert((id, etag), data)
+        if self.persist:
+            fn = self.path(id, etag)
+            try:
+                os.makedirs(os.path.dirname(fn), exist_ok=True)
+                # write and rename, so that other workers never read a
+                # partial image
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fn), suffix=".tmp")
+                try:
+                    with os.fdopen(fd, "wb") as f:
+                        f.write(data)
+                    os.replace(tmp, fn)
+                except:
+                    os.unlink(tmp)
+                    raise
+            except EnvironmentError as e:
+                log.warning("could not persist slice %s: %s", fn, e)
+            else:
+                self._track(fn, len(data))
+
+    def _insert(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= len(old)
+            self.entries[key] = data
+            self.nbytes += len(data)
+            while self.nbytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.nbytes -= len(evicted)
+                self.evictions += 1
+
+    def _track(self, fn, size):
+        evicted = []
+        with self.lock:
+            self.file_nbytes += size - self.files.pop(fn, 0)
+            self.files[fn] = size
+            while self.file_nbytes > self.max_file_bytes and self.files:
+                path, n = self.files.popitem(last=False)
+                self.file_nbytes -= n
+                self.file_evictions += 1
+                evicted.append(path)
+        for path in evicted:
+            try:
+                os.unlink(path)
+            except EnvironmentError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "file_hits": self.file_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "files": len(self.files),
+                "file_bytes": self.file_nbytes,
+                "max_file_bytes": self.max_file_bytes,
+                "file_evictions": self.file_evictions
+            }
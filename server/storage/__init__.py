@@ -25,10 +25,39 @@
 from __future__ import print_function
 
 import os
+import copy
+import time
 import numpy
+import logging
+import functools
+
+log = logging.getLogger(__name__)
+
+# Called as observer(name, value) with "load_seconds", "decode_seconds"
+# and "contents_bytes", the number of bytes read from .contents memmaps.
+observer = None
+
+def observe(name, value):
+    if observer is not None:
+        observer(name, value)
+
+def timed(name):
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if observer is None:
+                return fn(*args, **kwargs)
+            t0 = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                observer(name, time.perf_counter() - t0)
+        return wrapper
+    return decorate
 
 class voxel_storage:
     @staticmethod
+    @timed("load_seconds")
     def load(fn, lazy=False):
         meta = fn + ".meta" 
         fm = open(meta)
@@ -53,6 +82,33 @@ class voxel_storage:
             
 EXPLICIT, IMPLICIT = 1, 2
 
+# number of set bits for every byte value
+POPCOUNT = numpy.unpackbits(numpy.arange(256, dtype='uint8')[:, None], axis=1).sum(axis=1)
+
+def primitive_plane_counts(primitive, chunksize):
+    """
+    Number of set voxels in every plane of an implicit chunk, per axis,
+    derived from the axis aligned planes of the primitive.
+    """
+    cs = chunksize
+    if any(p.startswith("CONST") for p in primitive.split(',')):
+        return numpy.full((3, cs), cs * cs, dtype='int64')
+
+    planes = [set(), set(), set()]
+    for p in primitive.split(','):
+        a, o = p.split('=')
+        planes["XYZ".index(a)].add(int(o))
+
+    counts = numpy.zeros((3, cs), dtype='int64')
+    for dim in range(3):
+        # a plane along dim is full when it coincides with one of the
+        # primitive's planes, otherwise it intersects the other two axes'
+        # planes in lines of cs voxels that overlap in |p1| * |p2| voxels
+        n1, n2 = (len(planes[d]) for d in range(3) if d != dim)
+        counts[dim, :] = (n1 + n2) * cs - n1 * n2
+        counts[dim, list(planes[dim])] = cs * cs
+    return counts
+
 class chunked_storage_meta(voxel_storage):
     
     def __init__(self, filename, chunksize, numchunks, origin, voxelsize):
@@ -78,26 +134,29 @@ class chunked_storage(voxel_storage):
             
         self.primitives = list(map(str.strip, open(fn + ".primitives")))
         
+        # populated by plane_counts()
+        self.plane_count_table = None
+        
         nx, ny, nz = self.numchunks = self.ownnumchunks = chunks
-        s = 0
         self.avail = avail = numpy.zeros((nx, ny, nz, 2), dtype='uint64')
-        
-        loc = 0 # self.chunkdatasize
-        prim = 0
-        header = numpy.fromfile(fn + ".index", dtype='uint8')
-        
-        for i in range(nx):
-            for j in range(ny):
-                for k in range(nz):
-                    a = header[s]
-                    s += 1
-                    if a == 1:
-                        avail[i,j,k] = (1, loc)
-                        loc += self.chunkdatasize
-                    elif a == 2:
-                        avail[i,j,k] = (2, prim)
-                        prim += 1
-                        
+
+        # index is written with the z chunk index varying fastest
+        header = numpy.fromfile(fn + ".index", dtype='uint8', count=nx * ny * nz).reshape((nx, ny, nz))
+
+        explicit = header == EXPLICIT
+        implicit = header == IMPLICIT
+
+        # explicit chunks are stored consecutively in .contents, implicit
+        # chunks consecutively in .primitives, so the exclusive running
+        # count of each kind gives the chunk's position in either file.
+        locs = numpy.cumsum(explicit, dtype='uint64').reshape(header.shape) - explicit
+        prims = numpy.cumsum(implicit, dtype='uint64').reshape(header.shape) - implicit
+
+        avail[explicit, 0] = EXPLICIT
+        avail[explicit, 1] = locs[explicit] * self.chunkdatasize
+        avail[implicit, 0] = IMPLICIT
+        avail[implicit, 1] = prims[implicit]
+
         # print("Chunks: %d x %d x %d = %d, size = %d" % (nx, ny, nz, nx*ny*nz, chunksize)) 
         # print ("Primitive chunks", numpy.count_nonzero(header==2), "/", nx*ny*nz)
         # print ("Non-empty chunks", numpy.count_nonzero(header==1), "/", nx*ny*nz)
@@ -107,8 +166,10 @@ class chunked_storage(voxel_storage):
             return tuple(c * self.chunksize for c in self.numchunks)
         elif k == "ownshape":
             return tuple(c * self.chunksize for c in self.ownnumchunks)
+        raise AttributeError(k)
 
         
+    @timed("decode_seconds")
     def __getitem__(self, slices):
     
         # needs exactly one integer slice argument        
@@ -127,7 +188,7 @@ class chunked_storage(voxel_storage):
         offset = list(self.offset)
         offset[dim:dim+1] = []
         di, dj = offset
-        print("offset", offset)
+        log.debug("offset %s", offset)
         
         fixed = slices[dim]
         cs = self.chunksize
@@ -136,7 +197,7 @@ class chunked_storage(voxel_storage):
         
         img = numpy.full(result_shape, 0, dtype='uint8') # 2
         
-        print(slices)
+        log.debug("slices %s", slices)
         
         for i in range(chunks[0]):
             for j in range(chunks[1]):
@@ -157,16 +218,12 @@ class chunked_storage(voxel_storage):
                         zc = fixed_index_in_chunk
                         byte_slice = (bits[:,:,zc//8] & (1 << (zc % 8))) != 0
                     else:
-                        bytes = numpy.zeros((cs, cs, cs), dtype=bits.dtype)
-                        
-                        for bit_idx in range(8): 
-                            trim = tuple(slice(0,x) for x in bytes[:,:,bit_idx::8].shape) 
-                            q = (bits & (1 << bit_idx))[trim] != 0 
-                            bytes[:,:,bit_idx::8] = q
-                            
-                        key = [slice(None)] * 3
+                        # only the (cs, cs // 8) bytes of the x or y plane
+                        # are read, z is packed little endian in the bytes
+                        key = [slice(None)] * 2
                         key[dim] = fixed_index_in_chunk
-                        byte_slice = bytes[tuple(key)]
+                        byte_slice = numpy.unpackbits(bits[tuple(key)], axis=1, bitorder='little')
+                    observe("contents_bytes", cs * cs if dim == 2 else cs * cs // 8)
                     img_subset[:] = byte_slice
                         
                 elif chunk_type == IMPLICIT:
@@ -189,6 +246,156 @@ class chunked_storage(voxel_storage):
                                 key[dim:dim+1] = []
                                 img_subset[tuple(key)] = 1
         return img
+
+    def decode_chunk(self, chunk_type, chunk_offset, dim, lo, hi):
+        """
+        Decodes the planes lo..hi-1 along dim of a single chunk into a
+        uint8 block of chunk shape, with hi - lo planes along dim.
+        """
+        cs = self.chunksize
+        if chunk_type == EXPLICIT:
+            bits = self.data[chunk_offset:chunk_offset + self.chunkdatasize].reshape((cs, cs, cs // 8), order='F')
+            key = [slice(None)] * 3
+            if dim == 2:
+                key[2] = slice(lo // 8, (hi + 7) // 8)
+            else:
+                key[dim] = slice(lo, hi)
+            packed = bits[tuple(key)]
+            observe("contents_bytes", packed.size)
+            block = numpy.unpackbits(packed, axis=2, bitorder='little')
+            if dim == 2:
+                return block[:, :, lo % 8:lo % 8 + hi - lo]
+            return block
+
+        shape = [cs] * 3
+        shape[dim] = hi - lo
+        block = numpy.zeros(shape, dtype='uint8')
+        if chunk_type == IMPLICIT:
+            for p in self.primitives[chunk_offset].split(','):
+                if p.startswith("CONST"):
+                    block[:] = 1
+                else:
+                    a, o = p.split('=')
+                    ai = "XYZ".index(a)
+                    oi = int(o)
+                    key = [slice(None)] * 3
+                    if ai == dim:
+                        if not lo <= oi < hi:
+                            continue
+                        oi -= lo
+                    key[ai] = oi
+                    block[tuple(key)] = 1
+        return block
+
+    @timed("decode_seconds")
+    def slice_range(self, dim, start, stop):
+        """
+        Decodes the consecutive planes start..stop-1 perpendicular to dim
+        into an array of shape (stop - start, ...) in a single pass over
+        the chunks that intersect the range.
+        """
+        result_shape = list(self.shape)
+        result_shape[dim:dim+1] = []
+
+        chunks = list(self.ownnumchunks)
+        chunks[dim:dim+1] = []
+
+        offset = list(self.offset)
+        offset[dim:dim+1] = []
+        di, dj = offset
+
+        cs = self.chunksize
+        imgs = numpy.zeros([stop - start] + result_shape, dtype='uint8')
+
+        for fixed_chunk in range(start // cs, (stop - 1) // cs + 1):
+            lo = max(start - fixed_chunk * cs, 0)
+            hi = min(stop - fixed_chunk * cs, cs)
+            planes = imgs[fixed_chunk * cs + lo - start:fixed_chunk * cs + hi - start]
+
+            for i in range(chunks[0]):
+                for j in range(chunks[1]):
+                    ijk = [i, j]
+                    ijk.insert(dim, fixed_chunk)
+
+                    chunk_type, chunk_offset = self.avail[tuple(ijk)]
+                    if chunk_type == 0:
+                        continue
+
+                    block = self.decode_chunk(chunk_type, int(chunk_offset), dim, lo, hi)
+                    planes[:, (i-di)*cs:(i-di+1)*cs, (j-dj)*cs:(j-dj+1)*cs] = numpy.moveaxis(block, dim, 0)
+
+        return imgs
+
+    @timed("decode_seconds")
+    def plane_region(self, dim, offset, lo, hi):
+        """
+        Decodes the part lo..hi, (i, j) bounds within the plane, of the
+        plane at offset perpendicular to dim. Only the chunks that
+        intersect the part are decoded.
+        """
+        cs = self.chunksize
+        region = numpy.zeros((hi[0] - lo[0], hi[1] - lo[1]), dtype='uint8')
+        fixed_chunk, within = divmod(offset, cs)
+
+        for i in range(lo[0] // cs, (hi[0] - 1) // cs + 1):
+            for j in range(lo[1] // cs, (hi[1] - 1) // cs + 1):
+                ijk = [i, j]
+                ijk.insert(dim, fixed_chunk)
+
+                chunk_type, chunk_offset = self.avail[tuple(ijk)]
+                if chunk_type == 0:
+                    continue
+
+                block = numpy.moveaxis(self.decode_chunk(chunk_type, int(chunk_offset), dim, within, within + 1), dim, 0)[0]
+                i0, i1 = max(lo[0], i * cs), min(hi[0], (i + 1) * cs)
+                j0, j1 = max(lo[1], j * cs), min(hi[1], (j + 1) * cs)
+                region[i0 - lo[0]:i1 - lo[0], j0 - lo[1]:j1 - lo[1]] = block[i0 - i * cs:i1 - i * cs, j0 - j * cs:j1 - j * cs]
+
+        return region
+
+    def plane_counts(self, dim):
+        """
+        Number of set voxels in every plane perpendicular to dim over the
+        extent of this storage (ownshape). Computed once from per-chunk,
+        per-plane popcounts and kept with the storage.
+        """
+        if self.plane_count_table is None:
+            self.plane_count_table = self.compute_plane_counts()
+        return self.plane_count_table[dim]
+
+    def compute_plane_counts(self, batch=256):
+        cs = self.chunksize
+        chunk_type = self.avail[..., 0]
+        tables = [numpy.zeros((n, cs), dtype='int64') for n in self.ownnumchunks]
+
+        # explicit chunks, in the order in which they occur in .contents
+        ijk = numpy.nonzero(chunk_type == EXPLICIT)
+        for b in range(0, len(ijk[0]), batch):
+            n = min(batch, len(ijk[0]) - b)
+            # fortran ordered chunks, so in C order the axes are (chunk, zb, y, x)
+            blk = numpy.asarray(self.data[b * self.chunkdatasize:(b + n) * self.chunkdatasize]).reshape((n, cs // 8, cs, cs))
+            observe("contents_bytes", blk.size)
+            pc = POPCOUNT[blk]
+            per_plane = [
+                pc.sum(axis=(1, 2)),
+                pc.sum(axis=(1, 3)),
+                numpy.stack([((blk >> bit) & 1).sum(axis=(2, 3)) for bit in range(8)], axis=2).reshape((n, cs))
+            ]
+            for dim in range(3):
+                numpy.add.at(tables[dim], ijk[dim][b:b + n], per_plane[dim])
+
+        # implicit chunks, counted once per distinct primitive
+        ijk = numpy.nonzero(chunk_type == IMPLICIT)
+        distinct = {}
+        which = numpy.array([
+            distinct.setdefault(self.primitives[int(p)], len(distinct)) for p in self.avail[..., 1][ijk]
+        ], dtype='int64')
+        if len(distinct):
+            per_primitive = numpy.stack([primitive_plane_counts(p, cs) for p in distinct])
+            for dim in range(3):
+                numpy.add.at(tables[dim], ijk[dim], per_primitive[which, dim])
+
+        return [t.reshape(-1) for t in tables]
         
 class continous_storage(voxel_storage):
     
@@ -212,6 +419,20 @@ class continous_storage(voxel_storage):
         
     def __getitem__(self, slice):
         return self.arr[slice]
+
+    def slice_range(self, dim, start, stop):
+        key = [slice(None)] * 3
+        key[dim] = slice(start, stop)
+        return numpy.moveaxis(self.arr[tuple(key)], dim, 0)
+
+    def plane_region(self, dim, offset, lo, hi):
+        key = [slice(lo[0], hi[0]), slice(lo[1], hi[1])]
+        key.insert(dim, offset)
+        return self.arr[tuple(key)]
+
+    def plane_counts(self, dim):
+        axes = tuple(d for d in range(3) if d != dim)
+        return numpy.count_nonzero(self.arr, axis=axes)
         
 def attr_of_elems(a):
     return lambda elems: [getattr(x, a) for x in elems]
@@ -224,8 +445,10 @@ def harmonize(vs):
     chunkss = numpy.array(attr_of_elems('numchunks')(vs))
     mins = numpy.amin(origins, axis=0)
     maxs = numpy.amax(origins + chunkss, axis=0)
-    print(mins, maxs)
-    # Todo immutability
+    log.debug("harmonized extents %s %s", mins, maxs)
+    # Shallow copies, the storages passed in may be shared through the
+    # storage cache. The chunk index and memmap are not duplicated.
+    vs = list(map(copy.copy, vs))
     for v, o in zip(vs, origins):
         v.offset = mins - o
         v.numchunks = maxs - mins
@@ -0,0 +1,129 @@
+# Voxel Server
+# ============
+# A Python Flask wrapper around the voxelization toolkit voxec runtime.
+#
+# Copyright (c) 2022 Thomas Krijnen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import threading
+
+from collections import OrderedDict
+
+from . import voxel_storage
+
+
+def file_identity(fn):
+    """
+    (mtime, size) of the files backing a voxel storage, so that a
+    storage rewritten by voxec is not served from the cache.
+    """
+    data = fn + ".contents"
+    if not os.path.exists(data):
+        # continous storage keeps its bits in the file itself
+        data = fn
+    return tuple((st.st_mtime_ns, st.st_size) for st in map(os.stat, (fn + ".meta", data)))
+
+
+def storage_nbytes(vox):
+    """
+    Estimate of the heap memory held by a loaded storage. The .contents
+    memmap is not counted, its pages belong to the OS page cache.
+    """
+    n = 0
+    for attr in ("avail", "arr"):
+        arr = getattr(vox, attr, None)
+        if arr is not None:
+            n += arr.nbytes
+    n += sum(map(len, getattr(vox, "primitives", None) or ()))
+    return n
+
+
+class storage_cache(object):
+    """
+    A bounded LRU cache of loaded voxel storages keyed by (id, num) and
+    the identity of the files on disk. Evicts least recently used entries
+    when either the entry count or the byte estimate exceeds its limit.
+    Hits and misses are counted per entry, and evicted with it, and in
+    total.
+    """
+
+    def __init__(self, max_entries=32, max_bytes=512 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self.lock = threading.Lock()
+
+    def load(self, fn, key):
+        # raises FileNotFoundError for absent storages, same as load()
+        ident = file_identity(fn)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == ident:
+                self.entries.move_to_end(key)
+                entry[3] += 1
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            # the counts of a storage rewritten by voxec carry over
+            hits, misses = (entry[3], entry[4] + 1) if entry is not None else (0, 1)
+
+        # load outside of the lock, so that a slow load does not block
+        # requests for other storages
+        vox = voxel_storage.load(fn)
+        size = storage_nbytes(vox)
+
+        with self.lock:
+            self._remove(key)
+            if size <= self.max_bytes:
+                # [file identity, storage, byte estimate, hits, misses]
+                self.entries[key] = [ident, vox, size, hits, misses]
+                self.nbytes += size
+                while len(self.entries) > self.max_entries or self.nbytes > self.max_bytes:
+                    self._remove(next(iter(self.entries)))
+                    self.evictions += 1
+
+        return vox
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[2]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.nbytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "counters": {"%s/%s" % k: {"hits": e[3], "misses": e[4]} for k, e in self.entries.items()}
+            }
@@ -0,0 +1,83 @@
+# Voxel Server
+# ============
+# A Python Flask wrapper around the voxelization toolkit voxec runtime.
+#
+# Copyright (c) 2022 Thomas Krijnen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import numpy
+
+
+def downsample(a):
+    """
+    OR of every 2 by 2 block of a boolean array, odd sizes are padded.
+    """
+    padded = numpy.zeros(((a.shape[0] + 1) // 2 * 2, (a.shape[1] + 1) // 2 * 2), dtype=bool)
+    padded[:a.shape[0], :a.shape[1]] = a
+    return padded.reshape((padded.shape[0] // 2, 2, padded.shape[1] // 2, 2)).any(axis=(1, 3))
+
+
+class plane_pyramid(object):
+    """
+    OR pyramid of the plane at offset perpendicular to dim of a voxel
+    storage, where a pixel at level k is set when any voxel of its 2**k
+    by 2**k block is. Level 0 is not stored, its regions are decoded
+    from the chunks that intersect them. Level 1 is built from all
+    chunks of the plane at once and every next level from the one below,
+    on first use, so that a region of any level costs the same.
+    """
+
+    def __init__(self, vox, dim, offset):
+        self.vox, self.dim, self.offset = vox, dim, offset
+        shape = list(vox.shape)
+        shape[dim:dim+1] = []
+        self.shape = tuple(shape)
+        self.levels = {}
+
+    def level_shape(self, level):
+        return tuple(-(-n // (1 << level)) for n in self.shape)
+
+    def num_levels(self):
+        """
+        Number of levels up to the first one of a single pixel.
+        """
+        return max(int(n - 1).bit_length() for n in self.shape) + 1
+
+    def level(self, level):
+        if level not in self.levels:
+            if level == 1:
+                plane = self.vox.slice_range(self.dim, self.offset, self.offset + 1)[0]
+                self.levels[1] = downsample(plane != 0)
+            else:
+                self.levels[level] = downsample(self.level(level - 1))
+        return self.levels[level]
+
+    def region(self, level, lo, hi):
+        """
+        Part lo..hi, (i, j) bounds in pixels of the level, of a level.
+        """
+        if level == 0:
+            return self.vox.plane_region(self.dim, self.offset, lo, hi) != 0
+        return self.level(level)[lo[0]:hi[0], lo[1]:hi[1]]
+
+    def nbytes(self):
+        # levels may be added by other threads meanwhile
+        return sum(a.nbytes for a in list(self.levels.values()))
@@ -26,7 +26,16 @@ import numpy
 
 from PIL import Image
 
-def create_image(arr, axis, offset, grid=-1, colors=None):
+# grid shading of a value on zero, one or two grid lines, see colorize()
+GRID_SHADE = numpy.array([
+    numpy.arange(256),
+    numpy.arange(256) * 5 // 8,
+    # both factors are applied before dividing, as v * 25 // 8 // 8
+    numpy.arange(256) * 25 // 64
+], dtype=numpy.uint8)
+
+
+def colorize(d, grid=-1, colors=None):
 
     if colors is None:
         colors = numpy.array([(255,255,255,0),(0,0,0,255)], dtype=numpy.uint16)
@@ -34,62 +43,130 @@ def create_image(arr, axis, offset, grid=-1, colors=None):
     else:
         colors = numpy.array(colors, dtype=numpy.uint16)
 
-    key = [slice(None)] * 3
-    key[axis] = offset
-    a = colors[numpy.clip(arr[tuple(key)], 0, len(colors) - 1)]
+    a = colors[numpy.clip(d, 0, len(colors) - 1)]
     
     if grid > 0:
-        a[::grid,:] *= 5
-        a[:,::grid] *= 5
-        a[::grid,:] //= 8
-        a[:,::grid] //= 8
+        # view with a trailing channel axis, d may be a stack of planes
+        g = a.reshape(numpy.shape(d) + (-1,))
+        g[..., ::grid,:,:] *= 5
+        g[..., :,::grid,:] *= 5
+        g[..., ::grid,:,:] //= 8
+        g[..., :,::grid,:] //= 8
+        
+    return a
+    
+
+def create_image(arr, axis, offset, grid=-1, colors=None):
+
+    key = [slice(None)] * 3
+    key[axis] = offset
+    a = colorize(arr[tuple(key)], grid, colors)
     
     im = Image.fromarray(numpy.transpose(numpy.uint8(a), (1,0))[::-1,:])
     return im            
 
+
+def create_image_stack(planes, grid=-1, colors=None):
+    """
+    Renders a stack of planes, as returned by slice_range(), into a single
+    image with the frames laid out top to bottom. Every frame is oriented
+    as the image returned by create_image().
+    """
+    
+    a = colorize(planes, grid, colors)
+    a = numpy.transpose(numpy.uint8(a), (0,2,1))[:,::-1,:]
+    
+    im = Image.fromarray(a.reshape((-1, a.shape[2])))
+    return im
+
+
+def create_tile(d, origin=(0, 0), grid=-1, colors=None):
+    """
+    Renders a part of a plane, oriented as create_image() does, where
+    origin is the position of the part within the plane, so that the
+    grid lines continue across parts.
+    """
+    
+    a = numpy.uint8(colorize(d, colors=colors))
+    if grid > 0:
+        lines = ((numpy.arange(d.shape[0]) + origin[0]) % grid == 0)[:,None] * 1 + \
+                ((numpy.arange(d.shape[1]) + origin[1]) % grid == 0)[None,:] * 1
+        a = GRID_SHADE[lines, a]
+    
+    im = Image.fromarray(numpy.transpose(a, (1,0))[::-1,:])
+    return im
+
+
+def pack_plane(plane, chunksize=-1, rle=False):
+    """
+    Encodes a plane of occupancy for colouring by the client. Four int32
+    values, the two dimensions of the plane, the chunk size and whether
+    run length encoded, are followed by the plane in C order. Either as
+    bits packed little endian into bytes, or as uint32 lengths of the
+    alternating runs of empty and occupied voxels, starting with empty.
+    """
+    flat = numpy.ravel(plane) != 0
+    header = numpy.array(numpy.shape(plane) + (chunksize, int(rle)), dtype=numpy.int32)
+    if rle:
+        changes = numpy.flatnonzero(flat[1:] != flat[:-1]) + 1
+        bounds = numpy.concatenate(([0], changes, [len(flat)]))
+        runs = numpy.diff(bounds)
+        if len(flat) and flat[0]:
+            runs = numpy.concatenate(([0], runs))
+        data = numpy.uint32(runs)
+    else:
+        data = numpy.packbits(flat, bitorder='little')
+    return header.tobytes() + data.tobytes()
+
     
 class image_builder(object):
+    """
+    Composites slices of multiple voxel storages on a background colour.
+    Later layers are drawn on top, opaque unless their colour has a
+    fourth (alpha) component, the first layer is always opaque.
+    """
 
     def __init__(self, color, grid=-1):
-        self.a = None
-        self.mask = None
         self.bg = color
+        self.layers = []
+        self.spacing = grid
         
     def add(self, arr, axis, offset, color):
-        colors = numpy.array([self.bg, color[0:3]], dtype=numpy.uint16)
-
-        try:
-            alpha = numpy.float64(color[3]) / 255.
-        except:
-            alpha = None
-
-        
         key = [slice(None)] * 3
         key[axis] = offset
         
-        d = arr[tuple(key)]
-        # mask = d == 0
-        
-        a = colors[numpy.clip(d, 0, len(colors) - 1)]
-        
-        if self.a is None:
-            self.a = a
-            # self.mask = mask
-        else:
-            if alpha is None:
-                self.a[d > 0, :] = a[d > 0, :]
-            else:
-                self.a[d > 0, :] = numpy.float64(self.a[d > 0, :]) * (1. - alpha) + numpy.float64(a[d > 0, :]) * alpha
-            # self.a[~mask] = a[~mask]
-            # self.mask[mask] = False
+        alpha = color[3] if len(color) > 3 and self.layers else None
+        self.layers.append((arr[tuple(key)] > 0, color[0:3], alpha))
             
     def grid(self, spacing):
-        self.a[::spacing,:] *= 5
-        self.a[:,::spacing] *= 5
-        self.a[::spacing,:] //= 8
-        self.a[:,::spacing] //= 8
+        self.spacing = spacing
+        
+    def composite(self):
+        masks = numpy.stack([m for m, _, _ in self.layers])
+        colors = numpy.array([self.bg] + [c for _, c, _ in self.layers], dtype=numpy.uint32)
+        opaque = numpy.array([a is None for _, _, a in self.layers])
+        
+        # index into colors of the top-most opaque layer, 0 for background
+        covered = masks & opaque[:, None, None]
+        top = len(masks) - numpy.argmax(covered[::-1], axis=0)
+        top[~covered.any(axis=0)] = 0
+        a = colors[top]
+        
+        # translucent layers above it, blended in 8 bit fixed point
+        for i, (mask, color, alpha) in enumerate(self.layers):
+            if alpha is not None:
+                m = mask & (top <= i)
+                a[m] = (a[m] * (255 - alpha) + numpy.uint32(color) * alpha) // 255
+                
+        return numpy.uint8(a)
             
     def image(self):
-        if self.a is None:
+        if not self.layers:
             raise ValueError("Call add() first")
-        return Image.fromarray(numpy.transpose(numpy.uint8(self.a), (1,0,2))[::-1,:])
+        a = self.composite()
+        if self.spacing > 0:
+            lines = numpy.zeros(a.shape[0:2], dtype=numpy.uint8)
+            lines[::self.spacing,:] += 1
+            lines[:,::self.spacing] += 1
+            a = GRID_SHADE[lines[:,:,None], a]
+        return Image.fromarray(numpy.transpose(a, (1,0,2))[::-1,:])
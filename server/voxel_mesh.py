@@ -0,0 +1,148 @@
+import json
+import numpy
+
+import prepared_buffer
+from storage import voxel_storage
+
+# Faces perpendicular to an axis are merged into strips along this axis.
+# Never along z, so that a quad does not cross a storey elevation.
+MERGE_AXIS = {0: 1, 1: 0, 2: 0}
+
+# quad corners as (merge axis, third axis) steps, counter clockwise when
+# the cross product of the two axes points in the face normal direction
+CORNERS = numpy.array([(0, 0), (1, 0), (1, 1), (0, 1)])
+CORNERS_REVERSED = CORNERS[::-1][[3, 0, 1, 2]]
+
+def chunk_block(vox, ijk, dim=2, lo=0, hi=None):
+    """
+    Decodes the planes lo..hi-1 along dim of chunk ijk into a boolean
+    block, all False for empty chunks and outside of the grid.
+    """
+    cs = vox.chunksize
+    hi = cs if hi is None else hi
+    chunk_type, chunk_offset = 0, 0
+    if all(0 <= c < n for c, n in zip(ijk, vox.ownnumchunks)):
+        chunk_type, chunk_offset = map(int, vox.avail[tuple(ijk)])
+    return vox.decode_chunk(chunk_type, chunk_offset, dim, lo, hi) != 0
+
+def chunk_quads(vox, ijk):
+    """
+    Yields the boundary faces of chunk ijk per axis and direction as
+    merged quads, an (n, 4, 3) array of corner coordinates in voxels.
+    """
+    cs = vox.chunksize
+    block = chunk_block(vox, ijk)
+    if not block.any():
+        return
+    base = numpy.array(ijk) * cs
+
+    for a in range(3):
+        m = MERGE_AXIS[a]
+        t = 3 - a - m
+        cyclic = (m, t, a) in ((0, 1, 2), (1, 2, 0), (2, 0, 1))
+
+        b = numpy.moveaxis(block, a, 0)
+
+        for d in (1, -1):
+            neighbour = list(ijk)
+            neighbour[a] += d
+            plane = numpy.moveaxis(chunk_block(vox, neighbour, a, *((0, 1) if d == 1 else (cs - 1, cs))), a, 0)
+            if d == 1:
+                shifted = numpy.concatenate((b[1:], plane))
+            else:
+                shifted = numpy.concatenate((plane, b[:-1]))
+            faces = numpy.moveaxis(b & ~shifted, 0, a)
+
+            # runs of faces along the merge axis, nonzero() returns the
+            # run starts and ends in the same order
+            padded = numpy.zeros((cs, cs, cs + 2), dtype=numpy.int8)
+            padded[:, :, 1:-1] = faces.transpose((a, t, m))
+            edges = numpy.diff(padded, axis=2)
+            pa, pt, start = numpy.nonzero(edges == 1)
+            end = numpy.nonzero(edges == -1)[2]
+            if len(pa) == 0:
+                continue
+
+            corners = CORNERS if cyclic == (d == 1) else CORNERS_REVERSED
+            quads = numpy.empty((len(pa), 4, 3), dtype=numpy.int32)
+            quads[:, :, a] = (base[a] + pa + (d == 1))[:, None]
+            quads[:, :, m] = base[m] + numpy.where(corners[:, 0] == 0, start[:, None], end[:, None])
+            quads[:, :, t] = (base[t] + pt)[:, None] + corners[:, 1]
+
+            normal = numpy.zeros(3, dtype=numpy.int8)
+            normal[a] = d
+            yield quads, normal
+
+def mesh(vox, elevations=None):
+    """
+    Meshes the boundary of a chunked voxel storage. Returns the vertices
+    (four per quad, in world coordinates), triangles and normals, with
+    the quads ordered by storey, and the storey index and first quad of
+    every non-empty storey. Without elevations all quads form one group.
+    """
+    quads, normals = [], []
+    for ijk in numpy.argwhere(vox.avail[..., 0] != 0):
+        for q, n in chunk_quads(vox, ijk):
+            quads.append(q)
+            normals.append(numpy.broadcast_to(n, (len(q), 3)))
+
+    if quads:
+        quads = numpy.concatenate(quads)
+        normals = numpy.concatenate(normals)
+    else:
+        quads = numpy.zeros((0, 4, 3), dtype=numpy.int32)
+        normals = numpy.zeros((0, 3), dtype=numpy.int8)
+
+    origin = numpy.float32(vox.origin)
+    vertices = origin + quads * numpy.float32(vox.voxelsize)
+
+    if elevations:
+        # storey as in annotation_data, the last one below the quad
+        z = vertices[:, :, 2].min(axis=1)
+        storeys = numpy.maximum(numpy.searchsorted(elevations, z, side="left") - 1, 0)
+    else:
+        storeys = numpy.zeros(len(quads), dtype=numpy.int64)
+
+    order = numpy.argsort(storeys, kind="stable")
+    storeys = storeys[order]
+    vertices = vertices[order].reshape((-1, 3))
+    normals = numpy.float32(numpy.repeat(normals[order], 4, axis=0))
+
+    first = numpy.arange(len(quads), dtype=numpy.uint32)[:, None] * 4
+    indices = numpy.stack((first + [0, 1, 2], first + [0, 2, 3]), axis=1).reshape((-1, 3))
+
+    group_storeys, group_starts = numpy.unique(storeys, return_index=True)
+    return vertices, indices, normals, list(zip(group_storeys.tolist(), group_starts.tolist()))
+
+# inputs: (voxel storage filename, color, annotate), annotated inputs
+# have their groups written to ofn_data as annotation_data.create() does
+# storeys: (elevations, GlobalIds) as returned by annotation_data.load_storeys()
+def create(ofn, ofn_data, inputs, storeys=None, compact=False, grid=0.05):
+    elevations, ids = storeys or (None, None)
+
+    meshes = [mesh(voxel_storage.load(fn), elevations) for fn, _, _ in inputs]
+
+    nv = sum(len(m[0]) for m in meshes)
+    nf = sum(len(m[1]) for m in meshes)
+    ng = sum(len(m[3]) for m in meshes)
+    regions, mm = prepared_buffer.allocate(ofn, nv, nf, 0, ng, compact)
+
+    offsets = []
+    annotations = []
+    vb, fb = 0, 0
+
+    for (fn, clr, annotate), (vertices, indices, normals, groups) in zip(inputs, meshes):
+        regions["vertices"][vb:vb + len(vertices)] = vertices
+        regions["indices"][fb:fb + len(indices)] = indices + vb
+        regions["normals"][vb:vb + len(vertices)] = prepared_buffer.encode_normals(normals, compact)
+
+        for storey, quad in groups:
+            offsets.append([(fb + quad * 2) * 3, (vb + quad * 4) * 3, clr])
+            if annotate:
+                annotations.append({"name": "group%d" % len(annotations), "storey": ids[storey] if ids else None})
+
+        vb, fb = vb + len(vertices), fb + len(indices)
+
+    prepared_buffer.finish(ofn, regions, mm, offsets, compact, grid)
+
+    json.dump(annotations, open(ofn_data, "w"))